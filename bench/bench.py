@@ -0,0 +1,465 @@
+#!/usr/bin/env python
+
+# Offline benchmarks for the Babysteps, BSFamily and attachment servers.
+#
+#   python bench/bench.py [broadcast|throughput|startup|family|upload|all]
+#                         [--clients N] [--changes N] [--json]
+#
+# Everything runs locally in temporary directories: servers listen on a
+# loopback port and are driven by simulated websocket clients and HTTP
+# pollers in the same process (so latencies include the clients' own work
+# and are an upper bound). Runs are seeded and sized by the options, so
+# the same command on the same machine gives comparable numbers.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from autobahn.twisted.websocket import (
+    WebSocketClientProtocol,
+    WebSocketClientFactory,
+    connectWS,
+)
+from twisted.internet import defer, reactor, task
+from twisted.web.client import Agent, readBody
+from twisted.web.resource import Resource
+from twisted.web.server import Site
+
+import guts
+from guts import babysteps
+
+
+def sleep(seconds):
+    return task.deferLater(reactor, seconds, lambda: None)
+
+
+def percentiles(samples):
+    if len(samples) == 0:
+        return {"n": 0}
+    samples = sorted(samples)
+
+    def pct(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+    return {
+        "n": len(samples),
+        "p50_ms": 1000 * pct(0.5),
+        "p90_ms": 1000 * pct(0.9),
+        "p99_ms": 1000 * pct(0.99),
+        "max_ms": 1000 * samples[-1],
+    }
+
+
+def listen(children):
+    root = Resource()
+    for name, res in children.items():
+        root.putChild(name, res)
+    port = reactor.listenTCP(0, Site(root), interface="127.0.0.1")
+    return port, port.getHost().port
+
+
+def make_log(path, n_changes, n_docs=1000):
+    # A changelog of `n_changes' sets spread over `n_docs' docs
+    with open(path, "w") as fh:
+        for idx in range(n_changes):
+            fh.write(
+                json.dumps(
+                    {
+                        "type": "set",
+                        "id": "doc%d" % (random.randrange(n_docs)),
+                        "val": {"type": "note", "n": idx, "text": "x" * 40},
+                        "date": 1e9 + idx,
+                        "peer": "bench",
+                    }
+                )
+                + "\n"
+            )
+
+
+class FakeClient:
+    # Enough of a client for DBFactory to broadcast to
+    codec = babysteps.JSON
+
+    def __init__(self, peer):
+        self.peer = peer
+
+    def sendMessage(self, payload, isBinary=False):
+        pass
+
+    def sendPreparedMessage(self, prepared):
+        pass
+
+
+# broadcast: latency from one client's change to everyone else seeing it
+
+
+class DBClient(WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.bench.opened(self)
+
+    def onMessage(self, payload, isBinary):
+        msg = json.loads(payload)
+        if msg.get("type") == "history":
+            if msg.get("done", True):
+                self.factory.bench.synced(self)
+        elif msg.get("type") == "changes":
+            for change in msg["changes"]:
+                self.factory.bench.received(change)
+        elif msg.get("type") == "set":
+            self.factory.bench.received(msg)
+
+
+class BroadcastBench:
+    def __init__(self, n_clients):
+        self.n_clients = n_clients
+        self.clients = []
+        self.synced_count = 0
+        self.latencies = []
+        self.all_synced = defer.Deferred()
+
+    def opened(self, client):
+        self.clients.append(client)
+
+    def synced(self, client):
+        self.synced_count += 1
+        if self.synced_count == self.n_clients:
+            self.all_synced.callback(None)
+
+    def received(self, change):
+        val = change.get("val") or {}
+        if "sent" in val:
+            self.latencies.append(time.time() - val["sent"])
+
+
+@defer.inlineCallbacks
+def bench_broadcast(args, tmpdir):
+    out = {}
+    for coalesce in (False, True):
+        db = guts.Babysteps(os.path.join(tmpdir, "bcast%d" % coalesce), coalesce=coalesce)
+        port, portno = listen({b"_db": db})
+
+        bench = BroadcastBench(args.clients)
+        for _idx in range(args.clients):
+            factory = WebSocketClientFactory("ws://127.0.0.1:%d/_db" % (portno))
+            factory.protocol = DBClient
+            factory.bench = bench
+            connectWS(factory)
+        yield bench.all_synced
+
+        sender = bench.clients[0]
+        expected = args.changes * (args.clients - 1)
+        start = time.time()
+        for idx in range(args.changes):
+            change = {"type": "set", "id": "doc%d" % (idx % 100), "val": {"sent": time.time()}}
+            sender.sendMessage(bytes(json.dumps(change), "utf-8"))
+            if idx % args.batch == args.batch - 1:
+                # Let the reactor breathe between bursts
+                yield sleep(0)
+
+        deadline = time.time() + args.timeout
+        while len(bench.latencies) < expected and time.time() < deadline:
+            yield sleep(0.01)
+        elapsed = time.time() - start
+
+        result = percentiles(bench.latencies)
+        result.update(
+            {
+                "clients": args.clients,
+                "changes": args.changes,
+                "delivered": len(bench.latencies),
+                "expected": expected,
+                "deliveries_per_sec": len(bench.latencies) / elapsed,
+            }
+        )
+        out["coalesce" if coalesce else "plain"] = result
+
+        for client in bench.clients:
+            client.sendClose()
+        yield sleep(0.1)
+        yield port.stopListening()
+        db._factory.close()
+    return out
+
+
+# throughput: changes/sec through DBFactory.onchange, without the network
+
+
+@defer.inlineCallbacks
+def bench_throughput(args, tmpdir):
+    out = {}
+    for durability in ("buffered", "group", "fsync"):
+        for Stepper in (babysteps.Babysteps, babysteps.CompactBabysteps):
+            n_changes = args.changes if durability != "fsync" else min(args.changes, 500)
+            factory = babysteps.DBFactory(
+                dbpath=os.path.join(tmpdir, "tp-%s-%s" % (durability, Stepper.__name__)),
+                Stepper=Stepper,
+                durability=durability,
+            )
+            for idx in range(args.clients):
+                client = FakeClient("fake%d" % (idx))
+                factory.clients[client.peer] = client
+
+            start = time.time()
+            durable = []
+            for idx in range(n_changes):
+                durable.append(
+                    factory.onchange(
+                        None,
+                        {"type": "set", "id": "doc%d" % (idx % 1000), "val": {"n": idx}},
+                    )
+                )
+            applied = time.time() - start
+            yield defer.DeferredList(durable)
+            written = time.time() - start
+
+            out["%s/%s" % (durability, Stepper.__name__)] = {
+                "changes": n_changes,
+                "applied_per_sec": n_changes / applied,
+                "durable_per_sec": n_changes / written,
+            }
+            factory.close()
+    return out
+
+
+# startup: loading a db versus its log size
+
+
+def bench_startup(args, tmpdir):
+    out = {}
+    for size in args.log_sizes:
+        dbpath = os.path.join(tmpdir, "startup%d" % (size))
+        make_log(dbpath, size)
+        row = {"log_bytes": os.path.getsize(dbpath)}
+
+        for Stepper in (babysteps.Babysteps, babysteps.CompactBabysteps):
+            start = time.time()
+            factory = babysteps.DBFactory(dbpath=dbpath, Stepper=Stepper)
+            row["load_s/%s" % (Stepper.__name__)] = time.time() - start
+
+            if Stepper is babysteps.Babysteps:
+                start = time.time()
+                json.dumps({"type": "history", "history": factory.history()})
+                row["history_dumps_s"] = time.time() - start
+
+                factory.write_snapshot()
+            factory.close()
+
+        start = time.time()
+        factory = babysteps.DBFactory(dbpath=dbpath)
+        row["load_s/with_snapshot"] = time.time() - start
+        factory.close()
+
+        out[str(size)] = row
+    return out
+
+
+# family: listing and querying versus the number of dbs
+
+
+@defer.inlineCallbacks
+def bench_family(args, tmpdir):
+    out = {}
+    agent = Agent(reactor)
+    for size in args.family_sizes:
+        family = guts.BSFamily("bench", localbase=os.path.join(tmpdir, "fam%d" % size))
+        uids = []
+        start = time.time()
+        for idx in range(size):
+            uids.append(family.create({"title": "doc %d" % (idx)})["id"])
+        created = time.time() - start
+
+        first = uids[0]
+        factory = family.open_db(first)._factory
+        for idx in range(args.changes):
+            factory.onchange(
+                None,
+                {"type": "set", "id": "n%d" % (idx), "val": {"type": random.choice(["a", "b"])}},
+            )
+
+        timings = {}
+        for name, fn in [
+            ("get_infos", lambda: family.get_infos()),
+            ("get_infos_page", lambda: family.get_infos(limit=50)),
+            ("query", lambda: family.query(id=first)),
+            ("query_type", lambda: family.query(id=first, type="a")),
+            ("query_since", lambda: family.query(id=first, since=time.time() - 1)),
+        ]:
+            samples = []
+            for _idx in range(args.repeat):
+                t0 = time.time()
+                fn()
+                samples.append(time.time() - t0)
+            timings[name] = percentiles(samples)
+
+        # ...and the same through HTTP, as pollers see it (mostly cached)
+        port, portno = listen({b"fam": family.res})
+        for name, path in [
+            ("http_infos", "/fam/_infos.json"),
+            ("http_query", "/fam/_query.json?id=%s" % (first)),
+        ]:
+            samples = []
+            for _idx in range(args.repeat):
+                t0 = time.time()
+                resp = yield agent.request(
+                    b"GET", bytes("http://127.0.0.1:%d%s" % (portno, path), "utf-8")
+                )
+                yield readBody(resp)
+                samples.append(time.time() - t0)
+            timings[name] = percentiles(samples)
+        yield port.stopListening()
+
+        timings["create_per_sec"] = size / created
+        out[str(size)] = timings
+        family.close_all()
+    return out
+
+
+# upload: MB/s through the attachment websocket
+
+
+class UploadClient(WebSocketClientProtocol):
+    def onOpen(self):
+        bench = self.factory.bench
+        self.sendMessage(
+            bytes(
+                json.dumps(
+                    {
+                        "type": "start-upload",
+                        "filename": "bench.bin",
+                        "size": len(bench.payload),
+                        "windowed": True,
+                    }
+                ),
+                "utf-8",
+            )
+        )
+
+    def pump(self):
+        bench = self.factory.bench
+        while self.sent < len(bench.payload) and self.sent - self.acked < self.window:
+            chunk = bench.payload[self.sent : self.sent + bench.chunk]
+            self.sendMessage(chunk, isBinary=True)
+            self.sent += len(chunk)
+
+    def onMessage(self, payload, isBinary):
+        msg = json.loads(payload)
+        if msg["type"] == "upload-started":
+            self.window = msg.get("window", 2 ** 20)
+            self.sent = self.acked = 0
+            self.pump()
+        elif msg["type"] == "got-chunk":
+            self.acked = msg["size"]
+            self.pump()
+        elif msg["type"] == "upload-finished":
+            self.factory.bench.done.callback(msg)
+            self.sendClose()
+
+
+@defer.inlineCallbacks
+def bench_upload(args, tmpdir):
+    out = {}
+    attach = guts.Attachments(os.path.join(tmpdir, "attach"))
+    port, portno = listen({b"_attach": attach})
+    for size_mb in args.upload_mb:
+
+        class Bench:
+            payload = os.urandom(size_mb * 2 ** 20)
+            chunk = 2 ** 18
+            done = defer.Deferred()
+
+        factory = WebSocketClientFactory("ws://127.0.0.1:%d/_attach" % (portno))
+        factory.protocol = UploadClient
+        factory.bench = Bench
+        start = time.time()
+        connectWS(factory)
+        yield Bench.done
+        elapsed = time.time() - start
+        out["%dMB" % (size_mb)] = {"seconds": elapsed, "MB_per_sec": size_mb / elapsed}
+    yield port.stopListening()
+    return out
+
+
+BENCHES = [
+    ("broadcast", bench_broadcast),
+    ("throughput", bench_throughput),
+    ("startup", bench_startup),
+    ("family", bench_family),
+    ("upload", bench_upload),
+]
+
+
+def print_results(name, results, as_json):
+    if as_json:
+        print(json.dumps({"bench": name, "results": results}))
+        return
+    print("== %s" % (name))
+
+    def show(key, row):
+        cells = []
+        for k, v in row.items():
+            if isinstance(v, dict):
+                show("%s %s" % (key, k), v)
+            else:
+                cells.append("%s=%s" % (k, ("%.4g" % v) if isinstance(v, float) else v))
+        if cells:
+            print("  %-28s %s" % (key, " ".join(cells)))
+
+    for key, row in results.items():
+        show(key, row)
+
+
+@defer.inlineCallbacks
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix="guts-bench-")
+    try:
+        for name, fn in BENCHES:
+            if args.bench not in (name, "all"):
+                continue
+            random.seed(args.seed)
+            results = yield defer.maybeDeferred(fn, args, tmpdir)
+            print_results(name, results, args.json)
+    except Exception:
+        import traceback
+
+        traceback.print_exc()
+    finally:
+        # After the servers' own shutdown triggers have had their say
+        reactor.addSystemEventTrigger(
+            "after", "shutdown", shutil.rmtree, tmpdir, ignore_errors=True
+        )
+        reactor.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="guts benchmarks")
+    parser.add_argument("bench", nargs="?", default="all",
+                        choices=[X[0] for X in BENCHES] + ["all"])
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--changes", type=int, default=2000)
+    parser.add_argument("--batch", type=int, default=50,
+                        help="changes sent per reactor tick in broadcast")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--log-sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--family-sizes", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--upload-mb", type=int, nargs="+", default=[1, 16, 64])
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="one JSON line per bench")
+    args = parser.parse_args()
+
+    reactor.callWhenRunning(run, args)
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,15 @@ from __future__ import absolute_import
 
 from .root import serve, Root
 from .util import (File,
-                   Get, GetArgs, PostJson, JsonPost,
-                   Babysteps, Attachments,
-                   Codestage,
-                   attach, bschange)
+                   Get, GetArgs, CachedGetArgs, PostJson, JsonPost, BadRequest,
+                   Babysteps, Attachments, AttachmentQuery,
+                   Codestage, AttachmentFile,
+                   attach, attach_tree, bschange)
 from .family import BSFamily
+from .babysteps import CompactBabysteps
+from .workers import WorkerPool
+from .metrics import Metrics
+from .profiling import Profiling, watch_stalls
 
 # Some aliases
 from twisted.internet import reactor
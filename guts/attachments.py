@@ -1,30 +1,82 @@
 # websocket-based chunked attachment database
 #
-# client: {type: start-upload, filename: filename, size: bytes}
-# server: {type: upload-started, id: <uid>}
+# client: {type: start-upload, filename: filename, size: bytes, [sha1: hex],
+#          [uploader: name]}
+# server: {type: upload-started, id: <uid>, token: <token>}
+#   ...or, if `sha1' is already in the store:
+# server: {type: upload-finished, id: null, path: <hashpath>, existing: true}
 #
 # client: <binary data>
 # server: {type: got-chunk, id: <uid>, size: <size-so-far>}
+#
+# Clients that send {..., windowed: true} with start-upload get a `window'
+# (bytes) in upload-started, may keep that many bytes unacknowledged in
+# flight, and get a got-chunk every `ack_bytes' rather than every chunk.
+#
+# To continue an interrupted upload (eg. after reconnecting), with the
+# (random) token from upload-started:
+# client: {type: resume-upload, token: <token>, offset: bytes}
+# server: {type: upload-resumed, id: <uid>, token: <token>, size: <size>}
+#   ...then send binary data from `size' onward
+#   ...or, if the token is unknown or its upload is still being written:
+# server: {type: resume-failed, token: <token>}
 
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
+from twisted.internet import reactor
+from twisted.web import http
+from twisted.web.static import File
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import hashlib
 import json
+import queue
 import shutil
 import os
+import tempfile
+import threading
+import time
+import uuid
+
+from . import metrics
 
 
 class AttachFactory(WebSocketServerFactory):
-    def __init__(self, attachdir="db/_attachments"):
+    def __init__(self, attachdir="db/_attachments", window=2 ** 23,
+                 ack_bytes=2 ** 21, max_pending=2 ** 24):
         self.attachdir = attachdir
 
+        # Flow control for uploads: a windowed client may have `window'
+        # bytes unacknowledged and is acked every `ack_bytes'; reading from
+        # a socket pauses while `max_pending' bytes wait for the disk.
+        self.window = window
+        self.ack_bytes = ack_bytes
+        self.max_pending = max_pending
+
         try:
             os.makedirs(attachdir)
         except OSError:
             pass
 
+        self.index = get_index(attachdir)
+        self.next_uids = {}  # upload dir -> next free uid
+        self.tokens = self._load_tokens()  # resume token -> upload filepath
+        self.writing = {}  # resume token -> UploadWriter still writing it
+
+        self.written = metrics.Meter()  # upload bytes on disk
+        self.uploads = metrics.Meter()
+        metrics.add_source("attachments", self)
+
         WebSocketServerFactory.__init__(self)
 
+    def metrics(self):
+        return {
+            "attachdir": self.attachdir,
+            "uploads": self.uploads.total,
+            "upload_bytes": self.written.total,
+            "upload_bytes_per_sec": self.written.rate(),
+            "indexed": len(self.index.records),
+        }
+
     def start_upload(self, peer):
         # return (id, filepath)
         upload_dir = os.path.join(self.attachdir, "uploading", peer.peer)
@@ -33,24 +85,81 @@ class AttachFactory(WebSocketServerFactory):
         except OSError:
             pass
 
-        uid = 0
-        while os.path.exists(os.path.join(upload_dir, str(uid))):
-            uid += 1
+        if upload_dir not in self.next_uids:
+            # List the directory once; then count up from there
+            uids = [int(X) for X in os.listdir(upload_dir) if X.isdigit()]
+            self.next_uids[upload_dir] = max(uids) + 1 if uids else 0
+        uid = self.next_uids[upload_dir]
+        self.next_uids[upload_dir] += 1
 
         return uid, os.path.join(upload_dir, str(uid))
 
+    def _load_tokens(self):
+        # Unfinished uploads keep their token in their .meta.json
+        tokens = {}
+        upload_root = os.path.join(self.attachdir, "uploading")
+        if not os.path.isdir(upload_root):
+            return tokens
+        for dirname in os.listdir(upload_root):
+            upload_dir = os.path.join(upload_root, dirname)
+            if not os.path.isdir(upload_dir):
+                continue
+            for filename in os.listdir(upload_dir):
+                if not filename.endswith(".meta.json"):
+                    continue
+                try:
+                    meta = json.load(open(os.path.join(upload_dir, filename)))
+                except ValueError:
+                    continue
+                if isinstance(meta, dict) and meta.get("token"):
+                    tokens[meta["token"]] = os.path.join(
+                        upload_dir, filename[: -len(".meta.json")]
+                    )
+        return tokens
+
+    def new_token(self, filepath):
+        # An unguessable name for an upload, for resuming it
+        token = uuid.uuid4().hex
+        self.tokens[token] = filepath
+        return token
+
+    def find_upload(self, token):
+        # Path of an unfinished upload from its token, or None
+        if not isinstance(token, str):
+            return None
+        filepath = self.tokens.get(token)
+        if filepath is None or not os.path.exists(filepath):
+            return None
+        return filepath
+
+    def release(self, token, writer):
+        # `writer' has let go of its upload's file
+        if self.writing.get(token) is writer:
+            del self.writing[token]
+
+    def end_upload(self, token):
+        self.tokens.pop(token, None)
+        self.writing.pop(token, None)
+
+    def find_existing(self, hashstr, ext):
+        # Path of content already in the store, or None (also for anything
+        # that isn't a sha1, so clients can't probe elsewhere)
+        if not is_hash(hashstr):
+            return None
+        hashpath = hash_path(hashstr, ext)
+        if os.path.exists(os.path.join(self.attachdir, hashpath)):
+            return hashpath
+        return None
+
     def import_file(self, filepath):
         # Moves a file into the attachment store and returns the path
+        return attach(filepath, self.attachdir)
 
-        # Compute hash
-        sha1 = hashlib.sha1()
-        with open(filepath) as fh:
-            buf = fh.read(2 ** 15)
-            while len(buf) > 0:
-                sha1.update(buf)
-                buf = fh.read(2 ** 15)
-
-        return move_to_database(filepath, sha1.hexdigest(), self.attachdir)
+    def identify(self, cmd, sender):
+        # Who is uploading, as recorded in the index. By default whatever
+        # the client says; override to use eg. a session.
+        uploader = cmd.get("uploader")
+        return uploader if isinstance(uploader, str) else None
 
     def onupload(self, cmd, sender):
         # Can return extra information to be sent on
@@ -58,79 +167,531 @@ class AttachFactory(WebSocketServerFactory):
         return {}
 
 
+class UploadWriter:
+    # Writes and hashes an upload's chunks, in order, on a worker thread.
+    # Callbacks run on the reactor: on_written(nbytes) after each chunk,
+    # on_done(hexdigest) once finish()ed, on_aborted() once abort()ed.
+
+    REHASH = object()
+    ABORT = object()
+
+    def __init__(self, fh, sha1, on_written, on_done, on_aborted=None):
+        self.fh = fh
+        self.sha1 = sha1
+        self.on_written = on_written
+        self.on_done = on_done
+        self.on_aborted = on_aborted
+
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="upload %s" % fh.name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def rehash(self):
+        # Hash what's already in the file, then report it as written
+        self.queue.put(self.REHASH)
+
+    def write(self, chunk):
+        self.queue.put(chunk)
+
+    def finish(self):
+        self.queue.put(None)
+
+    def abort(self):
+        self.queue.put(self.ABORT)
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self.ABORT:
+                self.fh.close()
+                if self.on_aborted is not None:
+                    reactor.callFromThread(self.on_aborted)
+                return
+            if item is None:
+                self.fh.close()
+                reactor.callFromThread(self.on_done, self.sha1.hexdigest())
+                return
+
+            if item is self.REHASH:
+                self.fh.seek(0)
+                nbytes = 0
+                buf = self.fh.read(2 ** 15)
+                while len(buf) > 0:
+                    self.sha1.update(buf)
+                    nbytes += len(buf)
+                    buf = self.fh.read(2 ** 15)
+            else:
+                self.fh.write(item)
+                self.sha1.update(item)
+                nbytes = len(item)
+            reactor.callFromThread(self.on_written, nbytes)
+
+
 class AttachProtocol(WebSocketServerProtocol):
+    cur_writer = None
+
     def onMessage(self, payload, isBinary):
         if not isBinary:
             cmd = json.loads(payload)
 
             if cmd["type"] == "start-upload":
-                id, self.cur_filepath = self.factory.start_upload(self)
-
-                self.cur_upload = cmd
-                self.cur_size = 0
-                self.cur_fh = open(self.cur_filepath, "wb")
-                self.cur_id = id
-                self.cur_sha1 = hashlib.sha1()
+                _r, ext = os.path.splitext(cmd["filename"])
+                if cmd.get("sha1"):
+                    hashpath = self.factory.find_existing(cmd["sha1"], ext)
+                    if hashpath is not None:
+                        # Nothing to transfer
+                        self._finish(cmd, None, hashpath, existing=True)
+                        return
+
+                id, filepath = self.factory.start_upload(self)
+                token = self.factory.new_token(filepath)
+
+                # Dump metadata (with the token, for resuming after a restart)
+                json.dump(dict(cmd, token=token), open("%s.meta.json" % (filepath), "w"))
+
+                self._begin(cmd, id, filepath, token, open(filepath, "wb"))
+                started = {"type": "upload-started", "id": id, "token": self.cur_token}
+                if cmd.get("windowed"):
+                    started["window"] = self.factory.window
+                self._send(started)
+
+            elif cmd["type"] == "resume-upload":
+                self._resume(cmd)
+
+        elif self.cur_writer is not None and self.cur_received < self.cur_upload["size"]:
+            # binary message -- add chunk (written off the reactor)
+            self.cur_writer.write(payload)
+            self.cur_received += len(payload)
+
+            pending = self.cur_received - self.cur_size
+            if not self.paused and pending > self.factory.max_pending:
+                # The disk is falling behind: stop reading from the socket
+                self.paused = True
+                self.transport.pauseProducing()
+
+            if self.cur_received >= self.cur_upload["size"]:
+                self.cur_writer.finish()
+
+    def connectionLost(self, reason):
+        if self.cur_writer is not None:
+            # The upload stays where it is, to be resumed
+            self.cur_writer.abort()
+            self.cur_writer = None
+        WebSocketServerProtocol.connectionLost(self, reason)
+
+    def _send(self, doc):
+        self.sendMessage(bytes(json.dumps(doc), "utf-8"))
+
+    def _begin(self, cmd, id, filepath, token, fh, rehash=False):
+        if self.cur_writer is not None:
+            self.cur_writer.abort()
+
+        self.cur_upload = cmd
+        self.cur_size = 0  # written
+        self.cur_received = fh.tell()
+        self.cur_acked = 0
+        self.cur_id = id
+        self.cur_filepath = filepath
+        self.cur_token = token
+        self.paused = False
+        self.resuming = rehash
+
+        writer = UploadWriter(
+            fh,
+            hashlib.sha1(),
+            lambda nbytes: self._written(writer, nbytes),
+            lambda hashstr: self._complete(writer, hashstr),
+            lambda: self.factory.release(token, writer),
+        )
+        self.cur_writer = writer
+        # Nobody else may resume it until this writer is done with the file
+        self.factory.writing[token] = writer
+        if rehash:
+            writer.rehash()
+        elif self.cur_received >= cmd["size"]:
+            # Empty: no data is coming
+            writer.finish()
+
+    def _written(self, writer, nbytes):
+        if writer is not self.cur_writer:
+            return
+
+        self.cur_size += nbytes
+        if not self.resuming:
+            self.factory.written.mark(nbytes)
+        pending = self.cur_received - self.cur_size
+        if self.paused and pending < self.factory.max_pending / 2:
+            self.paused = False
+            self.transport.resumeProducing()
+
+        if self.resuming:
+            # Rehashed what we had
+            self.resuming = False
+            self.cur_acked = self.cur_size
+            self._send(
+                {
+                    "type": "upload-resumed",
+                    "id": self.cur_id,
+                    "token": self.cur_token,
+                    "size": self.cur_size,
+                }
+            )
+            if self.cur_received >= self.cur_upload["size"]:
+                writer.finish()
+            return
+
+        if self.cur_size >= self.cur_upload["size"]:
+            # upload-finished is the last ack
+            return
+        if (
+            not self.cur_upload.get("windowed")
+            or self.cur_size - self.cur_acked >= self.factory.ack_bytes
+        ):
+            self.cur_acked = self.cur_size
+            self._send({"type": "got-chunk", "id": self.cur_id, "size": self.cur_size})
+
+    def _complete(self, writer, hashstr):
+        if writer is not self.cur_writer:
+            return
+        self.cur_writer = None
+
+        _r, ext = os.path.splitext(self.cur_upload["filename"])
+        hashpath = move_to_database(
+            self.cur_filepath, hashstr, self.factory.attachdir, ext=ext
+        )
+        os.remove("%s.meta.json" % (self.cur_filepath))
+        self.factory.end_upload(self.cur_token)
+
+        self._finish(self.cur_upload, self.cur_id, hashpath)
+
+    def _resume(self, cmd):
+        token = cmd.get("token")
+        filepath = self.factory.find_upload(token)
+        if filepath is None or token in self.factory.writing:
+            # Unknown, or still being written by another connection
+            self._send({"type": "resume-failed", "token": token})
+            return
+
+        # Keep what we have up to the client's offset; it is rehashed by
+        # the writer before we answer
+        fh = open(filepath, "r+b")
+        fh.truncate(min(int(cmd.get("offset", 0)), os.path.getsize(filepath)))
+        fh.seek(0, os.SEEK_END)
+
+        upload = json.load(open("%s.meta.json" % (filepath)))
+        upload.pop("token", None)
+        upload["windowed"] = cmd.get("windowed", upload.get("windowed"))
+        self._begin(
+            upload, int(os.path.basename(filepath)), filepath, token, fh, rehash=True
+        )
+
+    def _finish(self, upload, id, hashpath, existing=False):
+        upload["type"] = "finished-upload"
+        upload["path"] = hashpath
+        upload["uploader"] = self.factory.identify(upload, self)
+
+        outpath = os.path.join(self.factory.attachdir, hashpath)
+        if not existing:
+            json.dump(upload, open("%s.meta.json" % (outpath), "w"))
+
+        self.factory.index.add(
+            index_record(
+                hashpath, upload.get("filename"), upload.get("size"), upload["uploader"]
+            )
+        )
+
+        self.factory.uploads.mark()
+        ret = self.factory.onupload(upload, self)
+        up_doc = {
+            "type": "upload-finished",
+            "id": id,
+            "path": hashpath,
+        }
+        if existing:
+            up_doc["existing"] = True
+
+        if ret is not None:
+            up_doc.update(ret)
+
+        self._send(up_doc)
+
+
+class AttachmentFile(File):
+    # Serves the attachment store. Stored files are named by their hash, so
+    # they get the hash as a strong ETag and are cached forever; Range
+    # requests are handled by File.
+    #
+    # Behind a proxy that can send files itself (with sendfile), pass
+    # `accel_redirect' (nginx X-Accel-Redirect) or `sendfile_header' (eg.
+    # X-Sendfile) and we only send headers: see conf/nginx.example.conf.
+
+    max_age = 365 * 24 * 60 * 60
+
+    def __init__(self, path, defaultType="text/html", ignoredExts=(),
+                 registry=None, allowExt=0, accel_redirect=None,
+                 sendfile_header=None, root=None):
+        File.__init__(self, path, defaultType, ignoredExts, registry, allowExt)
+        self.accel_redirect = accel_redirect
+        self.sendfile_header = sendfile_header
+        self.root = os.path.abspath(root if root is not None else path)
+
+    def createSimilarFile(self, path):
+        f = File.createSimilarFile(self, path)
+        f.accel_redirect = self.accel_redirect
+        f.sendfile_header = self.sendfile_header
+        f.root = self.root
+        return f
+
+    def render_GET(self, request):
+        # Only stored files (not eg. the .meta.json files) have a hash
+        hashstr = path_hash(self.path) if self.isfile() else None
+        if hashstr is None:
+            return File.render_GET(self, request)
+
+        if request.setETag(bytes('"%s"' % (hashstr), "utf-8")) is http.CACHED:
+            return b""
+        request.setHeader(
+            b"cache-control", bytes("public, max-age=%d, immutable" % (self.max_age), "utf-8")
+        )
+
+        relpath = os.path.relpath(self.path, self.root)
+        if self.accel_redirect is not None:
+            request.setHeader(
+                b"x-accel-redirect",
+                bytes(self.accel_redirect.rstrip("/") + "/" + relpath, "utf-8"),
+            )
+            return b""
+        if self.sendfile_header is not None:
+            request.setHeader(
+                bytes(self.sendfile_header, "utf-8"),
+                bytes(os.path.abspath(self.path), "utf-8"),
+            )
+            return b""
+
+        return File.render_GET(self, request)
+
+
+class AttachIndex:
+    # Every finished upload or import, as an append-only file of JSON lines
+    # in the store, loaded into memory. Built from the .meta.json files the
+    # first time a store is opened.
+
+    def __init__(self, attachdir):
+        self.attachdir = attachdir
+        self.path = os.path.join(attachdir, "_index.jsonl")
 
-                # Dump metadata
-                json.dump(cmd, open("%s.meta.json" % (self.cur_filepath), "w"))
+        self.records = []
+        self.by_hash = {}  # hash -> latest record
 
-                self.sendMessage(
-                    bytes(json.dumps({"type": "upload-started", "id": id}), "utf-8")
-                )
+        if os.path.exists(self.path):
+            for line in open(self.path):
+                if len(line.strip()) > 0:
+                    self._add(json.loads(line))
+            self.fh = open(self.path, "a")
         else:
-            # binary message -- add chunk
-            self.cur_fh.write(payload)
-            self.cur_sha1.update(payload)
-            self.cur_size += len(payload)
-            if self.cur_size >= self.cur_upload["size"]:
-                # upload finished
-                self.cur_fh.close()
-
-                hashstr = self.cur_sha1.hexdigest()
-                _r, ext = os.path.splitext(self.cur_upload["filename"])
-                hashpath = move_to_database(
-                    self.cur_filepath, hashstr, self.factory.attachdir, ext=ext
+            try:
+                os.makedirs(attachdir)
+            except OSError:
+                pass
+            self.fh = open(self.path, "a")
+            self.rebuild()
+
+    def _add(self, record):
+        self.records.append(record)
+        self.by_hash[record["hash"]] = record
+
+    def add(self, record):
+        self._add(record)
+        self.fh.write("%s\n" % (json.dumps(record)))
+        self.fh.flush()
+
+    def get(self, hashstr):
+        return self.by_hash.get(hashstr)
+
+    def rebuild(self):
+        for dirpath, dirnames, filenames in os.walk(self.attachdir):
+            if "uploading" in dirnames:
+                dirnames.remove("uploading")
+            for filename in filenames:
+                if not filename.endswith(".meta.json"):
+                    continue
+                blobpath = os.path.join(dirpath, filename[: -len(".meta.json")])
+                hashpath = os.path.relpath(blobpath, self.attachdir)
+                if path_hash(hashpath) is None or not os.path.exists(blobpath):
+                    continue
+                meta = json.load(open(os.path.join(dirpath, filename)))
+                self.add(
+                    index_record(
+                        hashpath,
+                        meta.get("filename"),
+                        meta.get("size", os.path.getsize(blobpath)),
+                        meta.get("uploader"),
+                        date=os.path.getmtime(blobpath),
+                    )
                 )
 
-                self.cur_upload["type"] = "finished-upload"
-                self.cur_upload["path"] = hashpath
-
-                outpath = os.path.join(self.factory.attachdir, hashpath)
-                json.dump(self.cur_upload, open("%s.meta.json" % (outpath), "w"))
+    def query(self, hash=None, uploader=None, ext=None, filename=None, since=None,
+              limit=None):
+        # Newest first
+        if hash is not None:
+            records = [self.by_hash[hash]] if hash in self.by_hash else []
+        else:
+            records = self.records[::-1]
+        if uploader is not None:
+            records = [X for X in records if X.get("uploader") == uploader]
+        if ext is not None:
+            records = [X for X in records if X.get("ext") == ext]
+        if filename is not None:
+            records = [X for X in records if filename in (X.get("filename") or "")]
+        if since is not None:
+            records = [X for X in records if X["date"] > float(since)]
+        if limit is not None:
+            records = records[: int(limit)]
+        return records
+
+
+def index_record(hashpath, filename, size, uploader, date=None):
+    return {
+        "hash": path_hash(hashpath),
+        "path": hashpath,
+        "filename": filename,
+        "size": size,
+        "ext": os.path.splitext(hashpath)[1],
+        "uploader": uploader,
+        "date": date if date is not None else time.time(),
+    }
+
+
+_indexes = {}  # abspath -> AttachIndex
+
+
+def get_index(attachdir):
+    # One index per store, shared by everyone in the process
+    key = os.path.abspath(attachdir)
+    if key not in _indexes:
+        _indexes[key] = AttachIndex(attachdir)
+    return _indexes[key]
+
+
+def hash_path(hashstr, ext):
+    return os.path.join(hashstr[:2], "%s%s" % (hashstr[2:], ext))
+
+
+def is_hash(hashstr):
+    # A sha1 hexdigest, as we name things
+    return (
+        isinstance(hashstr, str)
+        and len(hashstr) == 40
+        and all([X in "0123456789abcdef" for X in hashstr])
+    )
+
+
+def path_hash(hashpath):
+    # Inverse of hash_path, or None if `hashpath' isn't one
+    prefix = os.path.basename(os.path.dirname(hashpath))
+    rest, _ext = os.path.splitext(os.path.basename(hashpath))
+    hashstr = prefix + rest
+    if len(prefix) != 2 or not is_hash(hashstr):
+        return None
+    return hashstr
+
+
+CHUNK = 2 ** 20
+
+
+def import_file(filepath, attachdir, copy=False):
+    # Puts a file into the store, reading it only once, and returns
+    # (hashpath, size). Copies (and moves across filesystems) hash while
+    # they copy into a temporary file; moves within a filesystem hash and
+    # then rename.
+    tmpdir = os.path.join(attachdir, "uploading", "_import")
+    try:
+        os.makedirs(tmpdir)
+    except OSError:
+        pass
 
-                ret = self.factory.onupload(self.cur_upload, self)
-                up_doc = {
-                    "type": "upload-finished",
-                    "id": self.cur_id,
-                    "path": hashpath,
-                }
+    _r, ext = os.path.splitext(filepath)
+    sha1 = hashlib.sha1()
+    size = 0
 
-                if ret is not None:
-                    up_doc.update(ret)
+    if not copy and os.stat(filepath).st_dev == os.stat(tmpdir).st_dev:
+        with open(filepath, "rb") as fh:
+            buf = fh.read(CHUNK)
+            while len(buf) > 0:
+                sha1.update(buf)
+                size += len(buf)
+                buf = fh.read(CHUNK)
+        return move_to_database(filepath, sha1.hexdigest(), attachdir, ext=ext), size
+
+    fd, tmppath = tempfile.mkstemp(dir=tmpdir)
+    with os.fdopen(fd, "wb") as out, open(filepath, "rb") as fh:
+        buf = fh.read(CHUNK)
+        while len(buf) > 0:
+            sha1.update(buf)
+            out.write(buf)
+            size += len(buf)
+            buf = fh.read(CHUNK)
+    shutil.copystat(filepath, tmppath)
+
+    hashpath = move_to_database(tmppath, sha1.hexdigest(), attachdir, ext=ext)
+    if not copy:
+        os.remove(filepath)
+    return hashpath, size
+
+
+def attach(filepath, attachdir="local/_attachments", copy=False):
+    # Imports a file and records it in the store's index
+    hashpath, size = import_file(filepath, attachdir, copy=copy)
+    get_index(attachdir).add(
+        index_record(hashpath, os.path.basename(filepath), size, "_server")
+    )
+    return hashpath
 
-                self.sendMessage(bytes(json.dumps(up_doc), "utf-8"))
 
-            else:
-                self.sendMessage(
-                    bytes(
-                        json.dumps(
-                            {
-                                "type": "got-chunk",
-                                "id": self.cur_id,
-                                "size": self.cur_size,
-                            }
-                        ),
-                        "utf-8",
-                    )
+def attach_tree(dirpath, attachdir="local/_attachments", copy=True, workers=4,
+                progress=None):
+    # Imports every file under `dirpath' on a pool of `workers' threads
+    # (hashing and file IO release the GIL). Returns {relpath: hashpath};
+    # progress(n_done, n_total, relpath, hashpath) is called as each
+    # finishes.
+    relpaths = []
+    for root, _dirnames, filenames in os.walk(dirpath):
+        for filename in filenames:
+            relpaths.append(os.path.relpath(os.path.join(root, filename), dirpath))
+
+    index = get_index(attachdir)
+    out = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = dict(
+            [
+                (
+                    pool.submit(
+                        import_file, os.path.join(dirpath, X), attachdir, copy=copy
+                    ),
+                    X,
                 )
+                for X in relpaths
+            ]
+        )
+        for future in as_completed(futures):
+            relpath = futures[future]
+            hashpath, size = future.result()
+            # The index isn't thread-safe: update it from here
+            index.add(
+                index_record(hashpath, os.path.basename(relpath), size, "_server")
+            )
+            out[relpath] = hashpath
+            if progress is not None:
+                progress(len(out), len(relpaths), relpath, hashpath)
+    return out
 
 
 def move_to_database(filename, hashstr, attachdir, ext=None, copy=False):
     if ext is None:
         _r, ext = os.path.splitext(filename)
 
-    hashpath = os.path.join(hashstr[:2], "%s%s" % (hashstr[2:], ext))
+    hashpath = hash_path(hashstr, ext)
 
     # Move to final location
     outpath = os.path.join(attachdir, hashpath)
@@ -5,19 +5,94 @@ from autobahn.twisted.resource import WebSocketResource
 from twisted.web.static import File
 from twisted.web.server import Site
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
 
+import array
+import bisect
+import collections
+import functools
 import time
 import json
 import os
+import queue
+import threading
 import uuid
 
+from guts import metrics
+
+
+# An encoding for websocket messages and changelog records. The binary ones
+# are optional dependencies.
+Codec = collections.namedtuple("Codec", ["name", "dumps", "loads", "binary"])
+
+ENCODINGS = ("json", "msgpack", "cbor")
+LOG_FORMATS = ("json", "msgpack")
+
+
+def get_codec(name):
+    if name == "json":
+        return Codec(name, lambda X: bytes(json.dumps(X), "utf-8"), json.loads, False)
+    if name == "msgpack":
+        import msgpack
+
+        return Codec(
+            name, msgpack.packb, lambda X: msgpack.unpackb(X, raw=False), True
+        )
+    if name == "cbor":
+        import cbor2
+
+        return Codec(name, cbor2.dumps, cbor2.loads, True)
+    raise ValueError("unknown encoding %r" % (name,))
+
+
+JSON = get_codec("json")
+
+
+def _hashable(val):
+    try:
+        hash(val)
+    except TypeError:
+        return False
+    return True
+
 
 class Babysteps:
-    def __init__(self, log=[], bs=None):
+    # Containers for the log and its dates; see CompactBabysteps
+    Log = list
+    Dates = list
+
+    def __init__(self, log=[], bs=None, snapshot=None, checkpoint_every=None,
+                 max_checkpoints=64):
         self.bs = bs
-        self.log = []
+        self.log = self.Log()
         self.db = {}
 
+        # Changes folded into a snapshot are not kept in `log'; `base_seq'
+        # is the sequence number of log[0]
+        self.base_seq = 0
+        self.base_date = None  # date of the last change before log[0]
+        self.created_time = None
+        self.modified_time = None
+
+        # Indexes, maintained by append()
+        self.by_type = {}  # doc type -> set(doc ids)
+        self.dates = self.Dates()  # running max of log[i]["date"], for bisecting
+        self.mtimes = {}  # doc id -> date of last change
+
+        # Point-in-time reads (at()) replay from the nearest checkpoint, a
+        # copy of `db' taken every `checkpoint_every' changes. Beyond
+        # `max_checkpoints', every other one is dropped and the interval
+        # doubles, bounding memory as the log grows. Checkpoints are off by
+        # default (they cost a copy of the db each): at() can then only
+        # replay a log that starts from nothing.
+        self.checkpoints = [(0, {})]  # [(seq, db)], by seq
+        self.checkpoint_every = checkpoint_every
+        self.max_checkpoints = max_checkpoints
+
+        if snapshot is not None:
+            self.restore(snapshot)
+
         self.loaded = False
         for entry in log:
             self.append(entry)
@@ -29,9 +104,85 @@ class Babysteps:
             uid = uuid.uuid4().get_hex()[:8]
         return uid
 
+    @property
+    def seq(self):
+        # Total number of changes ever applied
+        return self.base_seq + len(self.log)
+
     def append(self, change):
         self.log.append(change)
 
+        date = change.get("date", 0)
+        self.dates.append(max(date, self.dates[-1]) if self.dates else date)
+        if change.get("date") is not None:
+            if self.created_time is None:
+                self.created_time = change["date"]
+            self.modified_time = change["date"]
+        if change.get("id") is not None:
+            self.mtimes[change["id"]] = date
+            old_doc = self.db.get(change["id"])
+            old_type = old_doc.get("type") if old_doc is not None else None
+
+        self.apply(change)
+
+        if change.get("id") is not None:
+            self._reindex(
+                change["id"], old_doc is not None, old_type, self.db.get(change["id"])
+            )
+
+        if (
+            self.checkpoint_every is not None
+            and self.seq - self.checkpoints[-1][0] >= self.checkpoint_every
+        ):
+            self._checkpoint()
+
+    def _checkpoint(self):
+        self.checkpoints.append((self.seq, self.copy_db(self.db)))
+        if len(self.checkpoints) > self.max_checkpoints:
+            # The first (at base_seq) is always kept
+            self.checkpoints = self.checkpoints[::2]
+            self.checkpoint_every *= 2
+
+    def copy_db(self, db):
+        # apply() replaces docs rather than modifying them, so they can be
+        # shared
+        return dict(db)
+
+    def seq_at(self, date):
+        # Number of changes made up to `date'
+        base_date = self.base_date
+        if base_date is None and len(self.dates) > 0:
+            base_date = self.dates[0]
+        if self.base_seq > 0 and base_date is not None and date < base_date:
+            # Only the snapshot's state is left from then
+            raise ValueError("date %r is before the snapshot at %r" % (date, base_date))
+        return self.base_seq + bisect.bisect_right(self.dates, date)
+
+    def at(self, seq=None, date=None):
+        # The db as it was after the first `seq' changes, or as of `date'.
+        # Only changes since the snapshot we started from can be undone.
+        if seq is None:
+            seq = self.seq_at(date) if date is not None else self.seq
+        if not self.base_seq <= seq <= self.seq:
+            raise ValueError(
+                "seq %d is outside [%d, %d]" % (seq, self.base_seq, self.seq)
+            )
+        if seq == self.seq:
+            return self.copy_db(self.db)
+
+        idx = bisect.bisect_right([X[0] for X in self.checkpoints], seq) - 1
+        if idx < 0:
+            raise ValueError("no checkpoint to replay seq %d from" % (seq,))
+        cp_seq, cp_db = self.checkpoints[idx]
+
+        # Replay onto a bare instance, whose apply() only needs `db'
+        replay = type(self).__new__(type(self))
+        replay.db = self.copy_db(cp_db)
+        for change in self.log[cp_seq - self.base_seq : seq - self.base_seq]:
+            replay.apply(change)
+        return replay.db
+
+    def apply(self, change):
         # Trivial DB accumulation
         if change.get("type") == "set":
             doc = dict(self.db.get(change["id"], {}))
@@ -53,88 +204,766 @@ class Babysteps:
             else:
                 del self.db[change["id"]]
 
+    def _reindex(self, id, existed, old_type, new_doc):
+        # Types that can't be dict keys (lists, dicts...) aren't indexed;
+        # see docs_of_type
+        new_type = new_doc.get("type") if new_doc is not None else None
+        if existed and (new_doc is None or old_type != new_type):
+            if _hashable(old_type):
+                self.by_type.get(old_type, set()).discard(id)
+        if new_doc is not None and _hashable(new_type):
+            self.by_type.setdefault(new_type, set()).add(id)
+
+    def docs_of_type(self, type):
+        # Ids of docs whose type is `type'
+        if _hashable(type):
+            return self.by_type.get(type, set())
+        return set([id for id, doc in self.db.items() if doc.get("type") == type])
+
+    def changed_since(self, date):
+        # Ids of docs changed after `date'
+        if self.base_seq > 0 and (len(self.dates) == 0 or self.dates[0] > date):
+            # Some of those changes predate the log
+            return set([id for id, mtime in self.mtimes.items() if mtime > date])
+
+        idx = bisect.bisect_right(self.dates, date)
+        return set(
+            [
+                X["id"]
+                for X in self.log[idx:]
+                if X.get("id") is not None and X.get("date", 0) > date
+            ]
+        )
+
+    def snapshot(self):
+        return {
+            "seq": self.seq,
+            "db": self.db,
+            "created_time": self.created_time,
+            "modified_time": self.modified_time,
+            "mtimes": self.mtimes,
+        }
+
+    def restore(self, snapshot):
+        self.db = dict(snapshot["db"])
+        self.log = self.Log()
+        self.dates = self.Dates()
+        self.base_seq = snapshot["seq"]
+        self.created_time = snapshot.get("created_time")
+        self.modified_time = snapshot.get("modified_time")
+        self.base_date = self.modified_time
+
+        self.mtimes = dict(snapshot.get("mtimes", {}))
+        self.by_type = {}
+        for id, doc in self.db.items():
+            self.mtimes.setdefault(id, self.modified_time or 0)
+            self._reindex(id, False, None, doc)
+
+        self.checkpoints = []
+        if self.checkpoint_every is not None:
+            self.checkpoints.append((self.base_seq, self.copy_db(self.db)))
+
+    def snapshot_changes(self):
+        # A synthetic log that rebuilds the current state, for clients that
+        # need changes we no longer hold
+        return [
+            {"type": "set", "id": id, "val": doc, "date": self.modified_time}
+            for id, doc in self.db.items()
+        ]
+
     @classmethod
     def fromfile(cls, path):
-        return cls([json.loads(X) for X in open(path) if X.strip()])
+        return cls(list(read_log(path, sniff_log_format(path) or "json")))
+
+
+class CompactLog:
+    # A list-like log that packs entries as JSON into one buffer, with an
+    # array of offsets; entries are decoded on access.
+    def __init__(self, entries=()):
+        self.buf = bytearray()
+        self.offsets = array.array("Q")
+        for entry in entries:
+            self.append(entry)
+
+    def append(self, change):
+        # Encode first: a change that can't be encoded leaves no trace
+        encoded = json.dumps(change, separators=(",", ":")).encode("utf-8")
+        self.offsets.append(len(self.buf))
+        self.buf += encoded
+
+    def _decode(self, idx):
+        end = self.offsets[idx + 1] if idx + 1 < len(self.offsets) else len(self.buf)
+        return json.loads(self.buf[self.offsets[idx] : end])
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self._decode(X) for X in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return self._decode(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self._decode(idx)
+
+
+class CompactBabysteps(Babysteps):
+    # Trades CPU for memory on long-lived docs: the log is a CompactLog and
+    # documents are updated in place instead of copied on every change, so
+    # doc dicts handed out earlier will see later changes.
+    Log = CompactLog
+    Dates = functools.partial(array.array, "d")
+
+    def copy_db(self, db):
+        # Docs change in place, but only at the top level
+        return dict([(id, dict(doc)) for id, doc in db.items()])
+
+    def apply(self, change):
+        if change.get("type") == "set":
+            doc = self.db.setdefault(change["id"], {})
+            if change.get("key") is not None:
+                doc[change["key"]] = change["val"]
+            else:
+                doc["_id"] = change["id"]
+                doc.update(change["val"])
+
+        if change.get("type") == "remove":
+            if change.get("key") is not None:
+                del self.db[change["id"]][change["key"]]
+            else:
+                del self.db[change["id"]]
+
+
+class ChangeWriter:
+    # Appends records to a changelog from a dedicated thread, so the reactor
+    # never waits on the disk. Durability policies:
+    #
+    #   buffered: write whatever is queued and flush it to the OS
+    #   group:    as buffered, but wait up to `group_ms' (or until
+    #             `group_size' lines are queued) and fsync each batch
+    #   fsync:    fsync after every line
+    #
+    # write() returns a Deferred that fires on the reactor once the line is
+    # as durable as the policy makes it, or errbacks if writing it failed
+    # (the writer carries on with the next batch).
+
+    POLICIES = ("buffered", "group", "fsync")
+
+    def __init__(self, path, durability="buffered", group_ms=10, group_size=100):
+        if durability not in self.POLICIES:
+            raise ValueError("unknown durability policy %r" % (durability,))
+
+        self.path = path
+        self.durability = durability
+        self.group_ms = group_ms
+        self.group_size = group_size
+
+        self.fh = open(path, "ab")
+        self.queue = queue.Queue()
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._run, name="changelog %s" % path)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, line):
+        if self.closed:
+            raise RuntimeError("changelog %s is closed" % (self.path,))
+        d = Deferred()
+        self.queue.put((line, d))
+        return d
+
+    def drain(self):
+        # Block until everything queued so far is written (or the writer
+        # thread is gone)
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks and self.thread.is_alive():
+                self.queue.all_tasks_done.wait(0.1)
+
+    def truncate(self):
+        self.drain()
+        self.fh.close()
+        self.fh = open(self.path, "wb")
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+        self.fh.close()
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        if batch[0] is None or self.durability == "fsync":
+            return batch
+
+        deadline = time.time() + self.group_ms / 1000.0
+        while len(batch) < self.group_size and batch[-1] is not None:
+            try:
+                if self.durability == "group":
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is None
+            if stop:
+                batch.pop()
+
+            try:
+                if batch:
+                    self._write(batch)
+            finally:
+                for _i in range(len(batch) + (1 if stop else 0)):
+                    self.queue.task_done()
+
+            if stop:
+                return
+
+    def _write(self, batch):
+        try:
+            self.fh.write(b"".join([line for line, _d in batch]))
+            self.fh.flush()
+            if self.durability != "buffered":
+                os.fsync(self.fh.fileno())
+        except Exception as err:
+            print("error writing %s: %s" % (self.path, err))
+            fail = Failure(err)
+            for _line, d in batch:
+                reactor.callFromThread(d.errback, fail)
+            return
+
+        for _line, d in batch:
+            reactor.callFromThread(d.callback, None)
 
 
 class DBFactory(WebSocketServerFactory):
-    def __init__(self, dbpath="db", Stepper=Babysteps):
+    # Number of log entries per message when streaming history to a
+    # resuming client
+    history_chunk = 5000
+
+    def __init__(self, dbpath="db", Stepper=Babysteps, snapshot_every=None,
+                 compact=False, durability="buffered", group_ms=10,
+                 group_size=100, coalesce=False, log_format="json",
+                 checkpoint_every=None, max_checkpoints=64):
         WebSocketServerFactory.__init__(self)
         self.clients = {}  # peerstr -> client
+        self.syncing = {}  # peerstr -> next seq to stream
+
+        # With `coalesce', changes are broadcast once per reactor tick as a
+        # single {type: changes} message
+        self.coalesce = coalesce
+        self.pending = []  # [(change_doc, sender)]
+
+        self.listeners = []  # fn(change_doc), called after each change
+
+        self.changes = metrics.Meter()
+        self.broadcast_bytes = 0
+
+        # New changelogs are written in `log_format'; existing ones keep
+        # whatever format they are in (see convert_log)
+        self.log_codec = get_codec(sniff_log_format(dbpath) or log_format)
 
         self.dbpath = dbpath
+        self.closed = False
+        self.snapshotpath = "%s.snapshot" % (dbpath)
         dbdir = os.path.dirname(self.dbpath)
         try:
             os.makedirs(dbdir)
         except OSError:
             pass
 
-        self.steps = Stepper(log=self.load_db(), bs=self)
+        # Write a snapshot every `snapshot_every' changes. With `compact',
+        # the changelog is truncated to what happened since the snapshot.
+        self.snapshot_every = snapshot_every
+        self.compact = compact
+
+        recovered = False
+        load_start = time.time()
+        snapshot = self.load_snapshot()
+        if snapshot is None:
+            self.log_base = 0
+            self.steps = Stepper(
+                log=self.load_db(),
+                bs=self,
+                checkpoint_every=checkpoint_every,
+                max_checkpoints=max_checkpoints,
+            )
+        else:
+            self.log_base = snapshot.get("log_base", 0)
+            skip = snapshot["seq"] - self.log_base
+            log = self.load_db(skip=skip)
+            if self.n_skipped < skip:
+                # A compaction was interrupted after truncating the log:
+                # everything left in it is newer than the snapshot.
+                self.log_base = snapshot["seq"]
+                log = self.load_db()
+                recovered = True
+            self.steps = Stepper(
+                log=log,
+                bs=self,
+                snapshot=snapshot,
+                checkpoint_every=checkpoint_every,
+                max_checkpoints=max_checkpoints,
+            )
+        self.last_snapshot_seq = self.steps.base_seq
+        self.load_time = time.time() - load_start
 
         # Create a changelog
-        self.change_fh = open(os.path.join(self.dbpath), "a")
+        self.writer = ChangeWriter(
+            self.dbpath,
+            durability=durability,
+            group_ms=group_ms,
+            group_size=group_size,
+        )
+        self._shutdown_trigger = reactor.addSystemEventTrigger(
+            "before", "shutdown", self.writer.close
+        )
 
-    def load_db(self):
+        if recovered:
+            self.write_snapshot()
+
+        metrics.add_source("babysteps", self)
+
+    def close(self):
+        # Flush everything out and release the changelog; no changes are
+        # taken after this
+        if self.closed:
+            return
+        self.closed = True
+        self.flush_pending()
+        self.writer.close()
+        reactor.removeSystemEventTrigger(self._shutdown_trigger)
+        metrics.remove_source("babysteps", self)
+
+    def metrics(self):
+        return {
+            "dbpath": self.dbpath,
+            "clients": len(self.clients),
+            "syncing": len(self.syncing),
+            "seq": self.steps.seq,
+            "log_length": len(self.steps.log),
+            "load_time_s": self.load_time,
+            "changes": self.changes.total,
+            "changes_per_sec": self.changes.rate(),
+            "broadcast_bytes": self.broadcast_bytes,
+        }
+
+    def load_db(self, skip=0):
+        # Records covered by a snapshot are skipped without being parsed
+        self.n_skipped = 0
         if not os.path.exists(self.dbpath):
             return []
+        log = []
         try:
-            return [json.loads(X) for X in open(self.dbpath) if len(X.strip()) > 0]
+            for change in read_log(self.dbpath, self.log_codec.name, skip=skip):
+                if change is None:
+                    self.n_skipped += 1
+                    continue
+                log.append(change)
+            return log
         except ValueError:
             print("Uh-oh", self.dbpath)
             import IPython
 
             IPython.embed()
 
+    def load_snapshot(self):
+        if not os.path.exists(self.snapshotpath):
+            return None
+        with open(self.snapshotpath) as fh:
+            return json.load(fh)
+
+    def write_snapshot(self):
+        # Snapshot is replaced atomically, after the log it refers to is on disk
+        self.writer.drain()
+
+        snapshot = self.steps.snapshot()
+        snapshot["log_base"] = self.log_base
+        self._dump_snapshot(snapshot)
+
+        if self.compact and self.log_base < snapshot["seq"]:
+            # Truncate the changelog. If we crash before the snapshot below is
+            # written, load_db sees a log shorter than the snapshot expects
+            # and recovers the new base from that.
+            self.writer.truncate()
+
+            self.log_base = snapshot["seq"]
+            snapshot["log_base"] = self.log_base
+            self._dump_snapshot(snapshot)
+
+        self.last_snapshot_seq = snapshot["seq"]
+
+    def _dump_snapshot(self, snapshot):
+        tmppath = "%s.tmp" % (self.snapshotpath)
+        with open(tmppath, "w") as fh:
+            json.dump(snapshot, fh)
+        os.rename(tmppath, self.snapshotpath)
+
     def register(self, client):
+        # History sent below includes any changes still waiting to go out
+        self.flush_pending()
         self.clients[client.peer] = client
 
-        # Send entire history
-        # TODO: login & update_seq
-        client.sendMessage(
-            bytes(json.dumps({"type": "history", "history": self.steps.log}), "utf-8")
+        # TODO: login
+        resume_seq = getattr(client, "resume_seq", None)
+        if resume_seq is None:
+            # Legacy clients get the entire history as one message
+            self.send(client, {"type": "history", "history": self.history()})
+            return
+
+        # Resuming clients get only the tail they are missing, streamed
+        # across reactor ticks. If we don't know where they are, start over.
+        reset = not (self.steps.base_seq <= resume_seq <= self.steps.seq)
+        if reset:
+            if self.steps.base_seq > 0:
+                # Older changes were compacted away: send current state
+                self._send_snapshot(client)
+                return
+            resume_seq = 0
+
+        self.syncing[client.peer] = resume_seq
+        self._stream_history(client, reset=reset)
+
+    def at(self, seq=None, date=None):
+        return self.steps.at(seq=seq, date=date)
+
+    def history(self):
+        if self.steps.base_seq > 0:
+            return self.steps.snapshot_changes() + self.steps.log[:]
+        return self.steps.log[:]
+
+    def send(self, client, doc):
+        codec = getattr(client, "codec", JSON)
+        client.sendMessage(codec.dumps(doc), isBinary=codec.binary)
+
+    def _send_snapshot(self, client):
+        # `seq' is the position the client is at once it has applied this
+        self.send(
+            client,
+            {
+                "type": "history",
+                "history": self.steps.snapshot_changes(),
+                "seq": self.steps.seq,
+                "snapshot": True,
+                "reset": True,
+                "done": True,
+            },
         )
 
+    def _stream_history(self, client, reset=False):
+        if self.clients.get(client.peer) is not client:
+            # Client went away mid-stream
+            return
+
+        # Pending changes go to the caught-up clients now; this client gets
+        # them from the log below
+        self.flush_pending()
+
+        base = self.steps.base_seq
+        start = self.syncing[client.peer]
+        end = min(start + self.history_chunk, self.steps.seq)
+        done = end == self.steps.seq
+
+        self.send(
+            client,
+            {
+                "type": "history",
+                "history": self.steps.log[start - base : end - base],
+                "seq": start,
+                "reset": reset,
+                "done": done,
+            },
+        )
+
+        if done:
+            # Caught up: subsequent changes arrive as regular broadcasts
+            del self.syncing[client.peer]
+        else:
+            self.syncing[client.peer] = end
+            reactor.callLater(0, self._stream_history, client)
+
     def unregister(self, client):
         if client.peer in self.clients:
             del self.clients[client.peer]
+            self.syncing.pop(client.peer, None)
             print("unregistered client", len(self.clients), "remain")
 
     def onchange(self, sender, change_doc):
-        if change_doc.get("seq_idx"):
-            if change_doc["seq_idx"] != len(self.steps.log):
-                sender.sendMessage(
-                    bytes(json.dumps({"type": "seq-confirm", "status": "fail"})),
-                    "utf-8",
-                )
+        return self._commit(sender, [change_doc], change_doc.get("seq_idx"), single=True)
+
+    def onbatch(self, sender, batch_doc):
+        # {type: batch, changes: [...], [seq_idx: n]} applies all of its
+        # changes or none: one seq_idx check, one log write, one broadcast
+        # (as {type: changes}) and one seq-confirm
+        return self._commit(sender, batch_doc.get("changes") or [], batch_doc.get("seq_idx"))
+
+    def check_changes(self, changes):
+        # Why `changes' can't be applied in order, or None if they can:
+        # anything apply() would fail on. Tracks just which docs (and keys)
+        # would exist.
+        docs = {}  # id -> set of keys, or None if absent
+        for change in changes:
+            if not isinstance(change, dict) or change.get("id") is None:
+                return "change without an id"
+            id = change["id"]
+            if not isinstance(id, str):
+                return "id %r is not a string" % (id,)
+            key = change.get("key")
+            if key is not None and not isinstance(key, str):
+                return "key %r of %s is not a string" % (key, id)
+            if id not in docs:
+                doc = self.steps.db.get(id)
+                docs[id] = set(doc.keys()) if doc is not None else None
+            keys = docs[id]
+
+            if change.get("type") == "set":
+                if "val" not in change:
+                    return "set of %s without a val" % (id,)
+                if key is None and not isinstance(change["val"], dict):
+                    return "set of %s without an object" % (id,)
+                keys = set() if keys is None else keys
+                keys.update([key] if key is not None else change["val"].keys())
+                docs[id] = keys
+            elif change.get("type") == "remove":
+                if keys is None or (key is not None and key not in keys):
+                    return "remove of missing %s" % (id if key is None else "%s.%s" % (id, key))
+                if key is None:
+                    docs[id] = None
+                else:
+                    keys.discard(key)
+        return None
+
+    def _commit(self, sender, changes, seq_idx, single=False):
+        if self.closed:
+            raise RuntimeError("%s is closed" % (self.dbpath,))
+        # Single changes have always treated a seq_idx of 0 as absent
+        checked = seq_idx is not None and (seq_idx or not single)
+        if checked:
+            if seq_idx != self.steps.seq:
+                self.send(sender, {"type": "seq-confirm", "status": "fail"})
                 return
 
-        change_doc["date"] = time.time()
-        change_doc["peer"] = sender.peer if sender is not None else "_server"
+        if not single:
+            error = self.check_changes(changes)
+            if error is not None:
+                self.send(sender, {"type": "batch-failed", "error": error})
+                return
+
+        date = time.time()
+        peer = sender.peer if sender is not None else "_server"
 
         # TODO: server should enforce consistent order
 
-        self.steps.append(change_doc)
+        records = []
+        for change_doc in changes:
+            change_doc["date"] = date
+            change_doc["peer"] = peer
+
+            self.steps.append(change_doc)
+            self.changes.mark()
+            for listener in self.listeners:
+                listener(change_doc)
+
+            # Serialize once per encoding, for both the changelog and the
+            # broadcast
+            encoded = {self.log_codec.name: self.log_codec.dumps(change_doc)}
+            record = encoded[self.log_codec.name]
+            if not self.log_codec.binary:
+                record += b"\n"
+            records.append(record)
+
+        # One write: a batch reaches the disk (and is confirmed) as a unit
+        durable = self.writer.write(b"".join(records))
+
+        if (
+            self.snapshot_every
+            and self.steps.seq - self.last_snapshot_seq >= self.snapshot_every
+        ):
+            self.write_snapshot()
+
+        # TODO: server should confirm update to sender (w/date)
+        if self.coalesce:
+            self.pending.extend([(X, sender) for X in changes])
+            if len(self.pending) == len(changes):
+                reactor.callLater(0, self.flush_pending)
+        elif single:
+            self.broadcast(changes[0], exclude=(sender,), encoded=encoded)
+        elif len(changes) > 0:
+            self.broadcast({"type": "changes", "changes": changes}, exclude=(sender,))
+
+        # Confirm once the change is on disk (per the durability policy). A
+        # failed write is reported here, and doesn't fail `durable' further.
+        durable.addCallbacks(
+            self._confirm,
+            self._write_failed,
+            callbackArgs=(sender, checked),
+            errbackArgs=(sender, checked),
+        )
 
-        self.change_fh.write("%s\n" % (json.dumps(change_doc)))
-        self.change_fh.flush()
+        return durable
 
+    def broadcast(self, doc, exclude=(), encoded=None):
+        # Encode and frame once per encoding, send the same buffer to everyone
+        if encoded is None:
+            encoded = {}
+        prepared = {}
         for client in self.clients.values():
-            if client != sender:
-                client.sendMessage(bytes(json.dumps(change_doc), "utf-8"))
-            # TODO: server should confirm update to sender (w/date)
+            # Clients still receiving history will pick this up from the log
+            if client in exclude or client.peer in self.syncing:
+                continue
+
+            codec = getattr(client, "codec", JSON)
+            if codec.name not in prepared:
+                if codec.name not in encoded:
+                    encoded[codec.name] = codec.dumps(doc)
+                prepared[codec.name] = self.prepareMessage(
+                    encoded[codec.name], isBinary=codec.binary
+                )
+            client.sendPreparedMessage(prepared[codec.name])
+            self.broadcast_bytes += len(encoded[codec.name])
+
+    def flush_pending(self):
+        # Send every change made this reactor tick as one message. Senders
+        # get their own changes filtered out, everyone else shares a frame.
+        pending, self.pending = self.pending, []
+        if len(pending) == 0:
+            return
+
+        senders = set([sender for _change, sender in pending])
+        self.broadcast(
+            {"type": "changes", "changes": [X[0] for X in pending]}, exclude=senders
+        )
 
-        if change_doc.get("seq_idx"):
-            sender.sendMessage(
-                bytes(json.dumps({"type": "seq-confirm", "status": "succeed"}), "utf-8")
-            )
+        for client in senders:
+            if client is None or self.clients.get(client.peer) is not client:
+                continue
+            if client.peer in self.syncing:
+                continue
+
+            changes = [change for change, sender in pending if sender != client]
+            if len(changes) > 0:
+                self.send(client, {"type": "changes", "changes": changes})
+
+    def _confirm(self, _result, sender, checked):
+        if checked and self.clients.get(sender.peer) is sender:
+            self.send(sender, {"type": "seq-confirm", "status": "succeed"})
+
+    def _write_failed(self, failure, sender, checked):
+        # Already applied and broadcast, but not on disk
+        print("changes to %s not written: %s" % (self.dbpath, failure.getErrorMessage()))
+        if checked and self.clients.get(sender.peer) is sender:
+            self.send(sender, {"type": "seq-confirm", "status": "fail"})
+
+
+def _json_safe(doc):
+    # Whether `doc' is a JSON object that survives a round trip
+    if not isinstance(doc, dict):
+        return False
+    try:
+        return json.loads(json.dumps(doc)) == doc
+    except (TypeError, ValueError):
+        return False
+
+
+def sniff_log_format(path):
+    # JSON changelogs are lines of objects; msgpack ones start with a map
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as fh:
+        first = fh.read(1)
+    if len(first) == 0:
+        return None
+    if first in b"{ \t\r\n":
+        return "json"
+    return "msgpack"
+
+
+def read_log(path, log_format, skip=0):
+    # Yields the changes in a changelog. The first `skip' records are not
+    # parsed, and yield None instead.
+    codec = get_codec(log_format)
+    with open(path, "rb") as fh:
+        if log_format == "json":
+            for line in fh:
+                if len(line.strip()) == 0:
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    yield None
+                    continue
+                yield codec.loads(line)
+        else:
+            import msgpack
+
+            unpacker = msgpack.Unpacker(fh, raw=False)
+            for _i in range(skip):
+                try:
+                    unpacker.skip()
+                except msgpack.OutOfData:
+                    return
+                yield None
+            for change in unpacker:
+                yield change
+
+
+def convert_log(src, dst, log_format):
+    # Rewrites a changelog in another format; snapshots are unaffected
+    if log_format not in LOG_FORMATS:
+        raise ValueError("unknown log format %r" % (log_format,))
+    codec = get_codec(log_format)
+    with open(dst, "wb") as fh:
+        for change in read_log(src, sniff_log_format(src) or "json"):
+            fh.write(codec.dumps(change))
+            if not codec.binary:
+                fh.write(b"\n")
 
 
 class DBProtocol(WebSocketServerProtocol):
+    def onConnect(self, request):
+        # Clients may resume from a known position with ?seq=<n>, where
+        # <n> is the number of log entries they already hold
+        self.resume_seq = None
+        seq = request.params.get("seq")
+        if seq:
+            try:
+                self.resume_seq = int(seq[0])
+            except ValueError:
+                pass
+
+        # ...and pick a binary encoding with ?encoding=msgpack (or cbor)
+        self.codec = JSON
+        encoding = request.params.get("encoding")
+        if encoding and encoding[0] in ENCODINGS:
+            self.codec = get_codec(encoding[0])
+
     def onOpen(self):
         self.factory.register(self)
         WebSocketServerProtocol.onOpen(self)
 
+    def reject(self, change_doc, error):
+        print("rejected change from %s: %s" % (self.peer, error))
+        if not isinstance(change_doc, dict):
+            return
+        if change_doc.get("type") == "batch":
+            self.factory.send(self, {"type": "batch-failed", "error": error})
+        elif change_doc.get("seq_idx"):
+            self.factory.send(self, {"type": "seq-confirm", "status": "fail"})
+
     def connectionLost(self, reason):
         self.factory.unregister(self)
         WebSocketServerProtocol.connectionLost(self, reason)
@@ -142,6 +971,18 @@ class DBProtocol(WebSocketServerProtocol):
     def onMessage(self, payload, isBinary):
         if not isBinary:
             change_doc = json.loads(payload)
+        elif self.codec.binary:
+            change_doc = self.codec.loads(payload)
+            if not _json_safe(change_doc):
+                # eg. msgpack bin or CBOR tags: we couldn't log (or send
+                # JSON clients) these
+                self.reject(change_doc, "not representable as JSON")
+                return
+        else:
+            return
+        if change_doc.get("type") == "batch":
+            self.factory.onbatch(self, change_doc)
+        else:
             self.factory.onchange(self, change_doc)
 
 
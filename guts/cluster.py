@@ -0,0 +1,382 @@
+from __future__ import absolute_import
+
+# Multi-process serving.
+#
+# Root(workers=N) turns the starting process into a master: it opens the
+# listening socket, re-runs the serving script N times with GUTS_WORKER=<i>
+# in the environment, and never returns. The workers share the public
+# socket (the kernel spreads connections between them), and each also
+# listens on a private loopback port of its own.
+#
+# Every database has one owning worker, picked by a hash of its path (or,
+# in a BSFamily, its uid). A worker asked for a database it doesn't own
+# relays the request to the owner's private port: websockets message by
+# message, plain HTTP through a reverse proxy. Broadcasts therefore only
+# ever happen in the owner.
+#
+# Workers also share a local channel, relayed by the master, of JSON lines
+# {topic, msg, from, to}. `to' addresses one worker; without it a message
+# goes to every other worker.
+
+from autobahn.twisted.resource import WebSocketResource
+from autobahn.twisted.websocket import (
+    WebSocketServerProtocol,
+    WebSocketServerFactory,
+    WebSocketClientProtocol,
+    WebSocketClientFactory,
+    connectWS,
+)
+from twisted.internet import reactor, protocol
+from twisted.internet.error import ProcessExitedAlready
+from twisted.protocols.basic import LineReceiver
+from twisted.web.proxy import ReverseProxyResource
+from twisted.web.resource import Resource
+
+from urllib.parse import urlencode
+import json
+import os
+import socket
+import sys
+import zlib
+
+PUBLIC_FD = 3
+PRIVATE_FD = 4
+
+
+def is_worker():
+    return "GUTS_WORKER" in os.environ
+
+
+def worker_index():
+    return int(os.environ.get("GUTS_WORKER", 0))
+
+
+def worker_count():
+    return int(os.environ.get("GUTS_WORKERS", 1))
+
+
+def owner(key):
+    if worker_count() == 1:
+        return 0
+    return zlib.crc32(key.encode("utf-8")) % worker_count()
+
+
+def owns(key):
+    return owner(key) == worker_index()
+
+
+def peer_port(index):
+    return int(os.environ["GUTS_PEERS"].split(",")[index])
+
+
+# Master
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, master, index):
+        self.master = master
+        self.index = index
+
+    def processEnded(self, reason):
+        self.master.ended(self.index, reason)
+
+
+class Master:
+    def __init__(self, port, interface, workers):
+        self.workers = workers
+        self.stopping = False
+
+        self.public = self._listen(interface, port)
+        self.private = [self._listen("127.0.0.1", 0) for X in range(workers)]
+
+        self.hub = HubFactory()
+        hub_port = reactor.listenTCP(0, self.hub, interface="127.0.0.1")
+
+        self.env = dict(os.environ)
+        self.env.update(
+            {
+                "GUTS_WORKERS": str(workers),
+                "GUTS_PEERS": ",".join([str(X.getsockname()[1]) for X in self.private]),
+                "GUTS_HUB": str(hub_port.getHost().port),
+            }
+        )
+
+        self.processes = {}
+        for index in range(workers):
+            self.spawn(index)
+
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def _listen(self, interface, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((interface, port))
+        sock.listen(128)
+        sock.setblocking(False)
+        return sock
+
+    def spawn(self, index):
+        env = dict(self.env, GUTS_WORKER=str(index))
+        self.processes[index] = reactor.spawnProcess(
+            WorkerProcess(self, index),
+            sys.executable,
+            [sys.executable] + sys.argv,
+            env=env,
+            childFDs={
+                0: 0,
+                1: 1,
+                2: 2,
+                PUBLIC_FD: self.public.fileno(),
+                PRIVATE_FD: self.private[index].fileno(),
+            },
+        )
+
+    def ended(self, index, reason):
+        del self.processes[index]
+        if self.stopping:
+            if len(self.processes) == 0 and reactor.running:
+                reactor.stop()
+            return
+        print("worker %d exited (%s); restarting" % (index, reason.value))
+        reactor.callLater(1, self.spawn, index)
+
+    def stop(self):
+        self.stopping = True
+        for process in self.processes.values():
+            try:
+                process.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+
+
+def run_master(port, interface, workers):
+    Master(port, interface, workers)
+    print("http://localhost:%d (%d workers)" % (port, workers))
+    reactor.run()
+
+
+class HubProtocol(LineReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = 2 ** 27
+
+    worker = None
+
+    def lineReceived(self, line):
+        if self.worker is None:
+            # The first line says who's talking
+            self.worker = json.loads(line)["worker"]
+            self.factory.workers[self.worker] = self
+            return
+
+        to = json.loads(line).get("to")
+        if to is not None:
+            targets = [self.factory.workers[to]] if to in self.factory.workers else []
+        else:
+            targets = [X for X in self.factory.workers.values() if X is not self]
+        for target in targets:
+            target.sendLine(line)
+
+    def connectionLost(self, reason):
+        if self.factory.workers.get(self.worker) is self:
+            del self.factory.workers[self.worker]
+
+
+class HubFactory(protocol.Factory):
+    protocol = HubProtocol
+
+    def __init__(self):
+        self.workers = {}  # index -> HubProtocol
+
+
+# Worker
+
+
+def adopt_ports(site):
+    for fd in (PUBLIC_FD, PRIVATE_FD):
+        reactor.adoptStreamPort(fd, socket.AF_INET, site)
+        os.close(fd)
+    channel.connect()
+
+
+class ChannelProtocol(LineReceiver):
+    delimiter = b"\n"
+    MAX_LENGTH = 2 ** 27
+
+    def connectionMade(self):
+        self.sendLine(bytes(json.dumps({"worker": worker_index()}), "utf-8"))
+        self.factory.channel._connected(self)
+
+    def lineReceived(self, line):
+        self.factory.channel._received(json.loads(line))
+
+
+class ChannelFactory(protocol.ClientFactory):
+    protocol = ChannelProtocol
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class Channel:
+    def __init__(self):
+        self.proto = None
+        self.backlog = []  # lines published before connecting
+        self.handlers = {}  # topic -> [fn(msg, sender)]
+
+    def connect(self):
+        reactor.connectTCP(
+            "127.0.0.1", int(os.environ["GUTS_HUB"]), ChannelFactory(self)
+        )
+
+    def subscribe(self, topic, fn):
+        self.handlers.setdefault(topic, []).append(fn)
+
+    def publish(self, topic, msg, to=None):
+        if worker_count() == 1:
+            return
+        line = bytes(
+            json.dumps(
+                {"topic": topic, "msg": msg, "from": worker_index(), "to": to}
+            ),
+            "utf-8",
+        )
+        if self.proto is None:
+            self.backlog.append(line)
+        else:
+            self.proto.sendLine(line)
+
+    def _connected(self, proto):
+        self.proto = proto
+        for line in self.backlog:
+            proto.sendLine(line)
+        self.backlog = []
+
+    def _received(self, env):
+        for fn in self.handlers.get(env["topic"], []):
+            fn(env["msg"], env["from"])
+
+
+channel = Channel()
+
+
+# Routing to owners
+
+
+class RelayClientProtocol(WebSocketClientProtocol):
+    def onOpen(self):
+        self.factory.downstream._upstream_open(self)
+
+    def onMessage(self, payload, isBinary):
+        self.factory.downstream.sendMessage(payload, isBinary)
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.downstream.sendClose()
+
+
+class RelayClientFactory(WebSocketClientFactory):
+    protocol = RelayClientProtocol
+
+    def __init__(self, url, downstream):
+        self.downstream = downstream
+        WebSocketClientFactory.__init__(self, url)
+
+    def clientConnectionFailed(self, connector, reason):
+        self.downstream.sendClose()
+
+
+class RelayProtocol(WebSocketServerProtocol):
+    # Stands in for the owner's protocol, passing messages both ways
+    upstream = None
+    closed = False
+
+    def onConnect(self, request):
+        self.backlog = []
+        url = "ws://127.0.0.1:%d%s" % (peer_port(self.factory.owner), request.path)
+        if request.params:
+            url += "?" + urlencode(request.params, doseq=True)
+        connectWS(RelayClientFactory(url, self))
+
+    def _upstream_open(self, upstream):
+        if self.closed:
+            upstream.sendClose()
+            return
+        self.upstream = upstream
+        for payload, isBinary in self.backlog:
+            upstream.sendMessage(payload, isBinary)
+        self.backlog = []
+
+    def onMessage(self, payload, isBinary):
+        if self.upstream is None:
+            self.backlog.append((payload, isBinary))
+        else:
+            self.upstream.sendMessage(payload, isBinary)
+
+    def connectionLost(self, reason):
+        self.closed = True
+        if self.upstream is not None:
+            self.upstream.sendClose()
+        WebSocketServerProtocol.connectionLost(self, reason)
+
+
+def Relay(owner_index):
+    # A websocket endpoint served by another worker
+    factory = WebSocketServerFactory()
+    factory.protocol = RelayProtocol
+    factory.owner = owner_index
+    res = WebSocketResource(factory)
+    res.owner = owner_index
+    return res
+
+
+def proxy(req, owner_index):
+    return ReverseProxyResource(
+        "127.0.0.1", peer_port(owner_index), req.path
+    ).render(req)
+
+
+class Proxy(Resource):
+    # An HTTP endpoint served by another worker
+    isLeaf = True
+
+    def __init__(self, owner_index):
+        self.owner = owner_index
+        Resource.__init__(self)
+
+    def render(self, req):
+        return proxy(req, self.owner)
+
+
+class Routed(Resource):
+    # Serves `res' here or at the owner of key(req); a key of None is local
+    isLeaf = True
+
+    def __init__(self, res, key):
+        self.res = res
+        self.key = key
+        Resource.__init__(self)
+
+    def render(self, req):
+        key = self.key(req)
+        if key is None or owns(key):
+            return self.res.render(req)
+        return proxy(req, owner(key))
+
+
+def arg_key(name):
+    def key(req):
+        vals = req.args.get(bytes(name, "utf-8"))
+        return vals[0].decode("utf-8") if vals else None
+
+    return key
+
+
+def body_key(name):
+    def key(req):
+        try:
+            cmd = json.load(req.content)
+        except ValueError:
+            cmd = None
+        req.content.seek(0)
+        return cmd.get(name) if isinstance(cmd, dict) else None
+
+    return key
@@ -1,37 +1,123 @@
-from guts.util import GetArgs, JsonPost, bschange, Babysteps
+from guts.util import CachedGetArgs, JsonPost, BadRequest, bschange, Babysteps
+from guts.subscriptions import SubscribeFactory, SubscribeProtocol
+from guts import cluster
 
+import bisect
+import collections
 import glob
+import json
 import os
+import time
 import uuid
 
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.web.resource import Resource
+from autobahn.twisted.resource import WebSocketResource
+
+
+class FamilyResource(Resource):
+    # Databases are looked up (and opened) on demand rather than put as
+    # children up front
+    def __init__(self, family):
+        self.family = family
+        Resource.__init__(self)
+
+    def getChild(self, name, request):
+        uid = name.decode("utf-8")
+        if uid in self.family.known:
+            if not cluster.owns(uid):
+                return cluster.Relay(cluster.owner(uid))
+            return self.family.open_db(uid)
+        return Resource.getChild(self, name, request)
 
 
 class BSFamily:
-    def __init__(self, doctype, localbase='local'):
+    def __init__(self, doctype, localbase='local', max_open=None, max_idle=None,
+                 **db_kw):
         self.localbase = localbase
 
         self.doctype = doctype
 
-        self.dbs = {}  # uid -> db_res
-
-        self.res = Resource()
+        # Databases are opened on first access. At most `max_open' stay
+        # open, and those unused for `max_idle' seconds are closed; both
+        # spare databases with connected clients.
+        self.max_open = max_open
+        self.max_idle = max_idle
+        self.db_kw = db_kw  # passed on to guts.Babysteps
+
+        self.known = set()  # uids on disk
+        self.dbs = collections.OrderedDict()  # uid -> db_res, open, LRU first
+        self.last_used = {}  # uid -> time
+
+        # Info index: kept current for open dbs by listening to their
+        # changes, remembered for closed ones
+        self.infos = {}  # uid -> info
+        self.stamps = {}  # uid -> changelog stamp when the info was taken
+        self.by_created = []  # sorted [(created_time, uid)]
+        self.by_modified = []  # sorted [(modified_time, uid)]
+        self.info_seq = 0  # bumped whenever the index changes
+
+        self.res = FamilyResource(self)
+
+        # Live queries
+        self.subs = SubscribeFactory(self)
+        self.subs.protocol = SubscribeProtocol
+
+        # Under Root(workers=N) each worker owns the dbs whose uid hashes to
+        # it, and the others learn about them over the cluster channel
+        self.topic = "family:%s" % (doctype)
+        self.next_rid = 0
+        self.pending_queries = {}  # rid -> callback(items)
+        # Doc changes only go to workers with subscriptions to the db
+        self.watching = {}  # uid owned elsewhere -> our subscriptions to it
+        self.watchers = {}  # uid we own -> set(worker indexes subscribed)
+        cluster.channel.subscribe(self.topic, self.on_peer)
+        cluster.channel.publish(self.topic, {"op": "hello"})
 
         self.load_from_disk()
         self.attach_resources()
+        if cluster.worker_count() > 1:
+            reactor.callWhenRunning(self.index_owned)
+
+        reactor.addSystemEventTrigger("before", "shutdown", self.close_all)
+        if max_idle is not None:
+            LoopingCall(self.evict_idle).start(max_idle, now=False)
 
     def attach_resources(self):
-        self.res.putChild(b"_info.json", GetArgs(self.get_info))
-        self.res.putChild(b"_query.json", GetArgs(self.query))
-        self.res.putChild(b"_infos.json", GetArgs(self.get_infos))
+        # Cached until the index (or for queries, the db's log) changes
+        self.res.putChild(
+            b"_info.json", CachedGetArgs(self.get_info, self.infos_version)
+        )
+        self.res.putChild(
+            b"_query.json", CachedGetArgs(self.query, self.query_version)
+        )
+        self.res.putChild(
+            b"_infos.json", CachedGetArgs(self.get_infos, self.infos_version)
+        )
+        self.res.putChild(b"_at.json", CachedGetArgs(self.get_at, self.query_version))
+
+        self.res.putChild(b"_subscribe", WebSocketResource(self.subs))
 
         self.res.putChild(b"_create", JsonPost(self.create))
         self.res.putChild(b"_update", JsonPost(self.update))
         self.res.putChild(b"_remove", JsonPost(self.remove))
 
+        if cluster.worker_count() > 1:
+            # Whatever names a db goes to its owner; listings and creation
+            # are served locally
+            for name, key in [
+                (b"_info.json", cluster.arg_key("id")),
+                (b"_query.json", cluster.arg_key("id")),
+                (b"_at.json", cluster.arg_key("id")),
+                (b"_update", cluster.body_key("id")),
+                (b"_remove", cluster.body_key("id")),
+            ]:
+                self.res.putChild(name, cluster.Routed(self.res.children[name], key))
+
     def next_id(self):
         uid = None
-        while uid is None or (uid in self.dbs):
+        while uid is None or (uid in self.known) or not cluster.owns(uid):
             uid = uuid.uuid4().hex[:8]
         return uid
 
@@ -55,7 +141,7 @@ class BSFamily:
             if key in meta_doc:
                 del meta_doc[key]
 
-        db = self.dbs[id]
+        db = self.open_db(id)
 
         old_meta = self.get_meta(id)
         # Remove everything that hasn't changed...
@@ -66,14 +152,14 @@ class BSFamily:
 
         # And send a change, if there's anything left
         if len(new_meta) > 0:
-            bschange(db, {"type": "set", "id": docid, "val": new_meta})
+            bschange(db, {"type": "set", "id": docid, "val": new_meta}, sync=True)
 
         return {"update": new_meta, "id": id, "docid": docid}
 
     def remove(self, cmd):
         uid = cmd["id"]
 
-        if not uid in self.dbs:
+        if not uid in self.known:
             print("Nothing to delete!", cmd)
             return
 
@@ -83,74 +169,320 @@ class BSFamily:
         except OSError:
             pass
 
-        # XXX: How do I remove from Twisted?
-        # self.res.removeChild(uid)
-        del self.dbs[uid]
+        if uid in self.dbs:
+            self.dbs.pop(uid)._factory.close()
+        self.known.discard(uid)
+        self.last_used.pop(uid, None)
+        self.stamps.pop(uid, None)
+        self.set_info(uid, None)
+        self.subs.onremove(uid)
 
         oldpath = "%s/%s/%s" % (self.localbase, self.doctype, uid)
         newpath = os.path.join(trashdir, uid)
         os.rename(oldpath, newpath)
+        if os.path.exists("%s.snapshot" % (oldpath)):
+            os.rename("%s.snapshot" % (oldpath), "%s.snapshot" % (newpath))
 
         return {"remove": uid}
 
+    def dbpath(self, uid):
+        return "%s/%s/%s" % (self.localbase, self.doctype, uid)
+
     def make_db(self, uid):
         # idempotent db initialization
+        self.known.add(uid)
+        return self.open_db(uid)
+
+    def open_db(self, uid):
+        if uid not in self.known or not cluster.owns(uid):
+            raise KeyError(uid)
+        self.last_used[uid] = time.time()
 
         if uid in self.dbs:
+            self.dbs.move_to_end(uid)
             return self.dbs[uid]
 
         # Create a babysteps endpoint
-        db = Babysteps(dbpath="%s/%s/%s" % (self.localbase, self.doctype, uid))
+        db = Babysteps(dbpath=self.dbpath(uid), partition=False, **self.db_kw)
+        db.reopen = lambda: self.open_db(uid)  # for bschange, once closed
         self.dbs[uid] = db
-        self.res.putChild(uid, db)
+        self.stamps.pop(uid, None)
+        self.set_info(uid, self.get_info_from(uid, db))
+        db._factory.listeners.append(lambda change: self.onchange(uid, change))
+
+        if self.max_open is not None:
+            for old_uid in list(self.dbs.keys()):
+                if len(self.dbs) <= self.max_open:
+                    break
+                if old_uid != uid:
+                    self.close_db(old_uid)
         return db
 
+    def close_db(self, uid):
+        # Returns False if the db is still in use
+        db = self.dbs[uid]
+        if len(db._factory.clients) > 0:
+            return False
+
+        db._factory.close()
+        del self.dbs[uid]
+
+        # Its info stays in the index, so it can be listed without opening
+        self.stamps[uid] = self.stamp(uid)
+        return True
+
+    def evict_idle(self):
+        now = time.time()
+        for uid in list(self.dbs.keys()):
+            if now - self.last_used.get(uid, 0) > self.max_idle:
+                self.close_db(uid)
+        self.save_infos()
+
+    def close_all(self):
+        for uid in list(self.dbs.keys()):
+            self.dbs.pop(uid)._factory.close()
+            self.stamps[uid] = self.stamp(uid)
+        self.save_infos()
+
+    def stamp(self, uid):
+        # Changes whenever the changelog is written to
+        try:
+            st = os.stat(self.dbpath(uid))
+        except OSError:
+            return None
+        return [st.st_size, st.st_mtime]
+
+    def infospath(self):
+        if cluster.worker_count() > 1:
+            return "%s/%s/_infos.%d.json" % (
+                self.localbase,
+                self.doctype,
+                cluster.worker_index(),
+            )
+        return "%s/%s/_infos.json" % (self.localbase, self.doctype)
+
+    def save_infos(self):
+        # Only closed dbs have a stamp; open ones are recomputed on load
+        infos = dict(
+            [
+                (uid, {"info": self.infos[uid], "stamp": stamp})
+                for uid, stamp in self.stamps.items()
+            ]
+        )
+        tmppath = "%s.tmp" % (self.infospath())
+        with open(tmppath, "w") as fh:
+            json.dump(infos, fh)
+        os.rename(tmppath, self.infospath())
+
     def load_from_disk(self):
-        # Load all BSDBs
+        # Find all BSDBs; they are opened when first used
         for dbpath in glob.glob("%s/%s/*[0-9a-f]" % (self.localbase, self.doctype)):
-            self.make_db(os.path.basename(dbpath))
+            self.known.add(os.path.basename(dbpath))
+
+        if os.path.exists(self.infospath()):
+            with open(self.infospath()) as fh:
+                infos = json.load(fh)
+            # Keep infos whose changelog hasn't been touched since
+            for uid, entry in infos.items():
+                if (
+                    uid in self.known
+                    and cluster.owns(uid)
+                    and entry["stamp"] == self.stamp(uid)
+                ):
+                    self.stamps[uid] = entry["stamp"]
+                    self.set_info(uid, entry["info"])
+
+    def infos_version(self, **_args):
+        return self.info_seq
+
+    def query_version(self, id=None, **_args):
+        return self.open_db(id)._factory.steps.seq
+
+    def set_info(self, uid, info):
+        self.info_seq += 1
+        if cluster.owns(uid):
+            cluster.channel.publish(self.topic, {"op": "info", "uid": uid, "info": info})
+        old = self.infos.pop(uid, None)
+        if old is not None:
+            self.by_created.remove((old["created_time"], uid))
+            self.by_modified.remove((old["modified_time"], uid))
+        if info is not None:
+            self.infos[uid] = info
+            bisect.insort(self.by_created, (info["created_time"], uid))
+            bisect.insort(self.by_modified, (info["modified_time"], uid))
+
+    def onchange(self, uid, change):
+        if uid in self.dbs:
+            self.set_info(uid, self.get_info_from(uid, self.dbs[uid]))
+            if change.get("id") is not None:
+                doc = self.dbs[uid]._factory.steps.db.get(change["id"])
+                self.subs.ondoc(uid, change["id"], doc)
+                for worker in self.watchers.get(uid, ()):
+                    cluster.channel.publish(
+                        self.topic,
+                        {"op": "doc", "uid": uid, "id": change["id"], "doc": doc},
+                        to=worker,
+                    )
+
+    def index_owned(self):
+        # Put every db this worker owns in the index, so that the others
+        # can list them
+        for uid in list(self.known):
+            if cluster.owns(uid) and uid not in self.infos:
+                self.get_info(uid)
+
+    def remote_query(self, uid, type, unless, cb):
+        # Runs query_items() at the worker owning `uid'; cb(items) gets the
+        # result, or None if the db is unknown there
+        rid = self.next_rid
+        self.next_rid += 1
+        self.pending_queries[rid] = cb
+        cluster.channel.publish(
+            self.topic,
+            {"op": "query", "rid": rid, "uid": uid, "type": type, "unless": unless},
+            to=cluster.owner(uid),
+        )
+
+    def watch(self, uid):
+        # A subscription here wants changes to `uid', owned elsewhere
+        self.watching[uid] = self.watching.get(uid, 0) + 1
+        if self.watching[uid] == 1:
+            cluster.channel.publish(
+                self.topic, {"op": "watch", "uid": uid}, to=cluster.owner(uid)
+            )
+
+    def unwatch(self, uid):
+        self.watching[uid] -= 1
+        if self.watching[uid] == 0:
+            del self.watching[uid]
+            cluster.channel.publish(
+                self.topic, {"op": "unwatch", "uid": uid}, to=cluster.owner(uid)
+            )
+
+    def on_peer(self, msg, sender):
+        op = msg["op"]
+        if op == "hello":
+            # A worker (re)joined: tell it about our dbs, and what we watch
+            # of its; whatever it watched before is gone
+            for uid, info in list(self.infos.items()):
+                if cluster.owns(uid):
+                    cluster.channel.publish(
+                        self.topic, {"op": "info", "uid": uid, "info": info}, to=sender
+                    )
+            for uid in self.watching:
+                if cluster.owner(uid) == sender:
+                    cluster.channel.publish(
+                        self.topic, {"op": "watch", "uid": uid}, to=sender
+                    )
+            for uid in list(self.watchers.keys()):
+                self._unwatched(uid, sender)
+        elif op == "watch":
+            self.watchers.setdefault(msg["uid"], set()).add(sender)
+        elif op == "unwatch":
+            self._unwatched(msg["uid"], sender)
+        elif op == "info":
+            uid = msg["uid"]
+            if msg["info"] is None:
+                self.known.discard(uid)
+                self.set_info(uid, None)
+                self.subs.onremove(uid)
+            else:
+                self.known.add(uid)
+                self.set_info(uid, msg["info"])
+        elif op == "doc":
+            self.subs.ondoc(msg["uid"], msg["id"], msg["doc"])
+        elif op == "query":
+            items = None
+            if msg["uid"] in self.known:
+                items = self.query_items(
+                    id=msg["uid"], type=msg["type"], unless=msg["unless"]
+                )
+            cluster.channel.publish(
+                self.topic,
+                {"op": "results", "rid": msg["rid"], "items": items},
+                to=sender,
+            )
+        elif op == "results":
+            cb = self.pending_queries.pop(msg["rid"], None)
+            if cb is not None:
+                cb(msg["items"])
+
+    def _unwatched(self, uid, worker):
+        workers = self.watchers.get(uid)
+        if workers is not None:
+            workers.discard(worker)
+            if len(workers) == 0:
+                del self.watchers[uid]
 
     def get_meta(self, uid):
         return self.get_doc(uid, "meta") or {}
 
     def get_doc(self, db_id, doc_id):
-        if db_id not in self.dbs:
+        if db_id not in self.known:
             return
-        return self.dbs[db_id]._factory.steps.db.get(doc_id)
+        return self.open_db(db_id)._factory.steps.db.get(doc_id)
 
     def query(self, id=None, type=None, since=None, unless=None):
-        db_bs = self.dbs[id]._factory.steps
+        items = self.query_items(id=id, type=type, since=since, unless=unless)
+        return [doc for _id, doc in items]
 
-        # Filter by `since'
-        if since is None:
-            docs = db_bs.db.values()
-        else:
-            since = float(since)
-
-            log_items = [X for X in db_bs.log if X.get("date", 0) > since]
-            uids = set([X["id"] for X in log_items])
-            docs = [db_bs.db.get(X) for X in uids]
+    def query_items(self, id=None, type=None, since=None, unless=None):
+        # As query(), as [(doc id, doc)]: docs set key by key have no _id
+        db_bs = self.open_db(id)._factory.steps
 
-        # Filter by `type'
+        # Narrow down by the indexes before touching any docs
+        ids = None
+        if since is not None:
+            ids = db_bs.changed_since(float(since))
         if type is not None:
-            docs = [X for X in docs if X.get("type") == type]
+            typed = db_bs.docs_of_type(type)
+            ids = typed if ids is None else ids & typed
+
+        if ids is None:
+            items = list(db_bs.db.items())
+        else:
+            items = [(X, db_bs.db[X]) for X in ids if X in db_bs.db]
 
         # Filter by `unless'
         if unless is not None:
             # Filter docs to those without the unless field
-            docs = [X for X in docs if not X.get(unless)]
+            items = [X for X in items if not X[1].get(unless)]
+
+        return items
 
-        return docs
+    def get_at(self, id=None, seq=None, date=None, docid=None):
+        # A db (or one doc in it) as of change number `seq' or time `date'
+        steps = self.open_db(id)._factory.steps
+        try:
+            if seq is not None:
+                seq = int(seq)
+            elif date is not None:
+                seq = steps.seq_at(float(date))
+            db = steps.at(seq=seq)
+        except ValueError as err:
+            raise BadRequest(str(err))
+        if seq is None:
+            seq = steps.seq
+
+        if docid is not None:
+            return {"seq": seq, "doc": db.get(docid)}
+        return {"seq": seq, "docs": list(db.values())}
 
     def get_info(self, id):
-        meta = dict(self.get_meta(id))
-        log = self.dbs[id]._factory.steps.log
+        if id not in self.infos:
+            # Opening a db puts it in the index
+            self.open_db(id)
+        return dict(self.infos[id])
+
+    def get_info_from(self, id, db):
+        meta = dict(db._factory.steps.db.get("meta") or {})
+        steps = db._factory.steps
 
-        if len(log) == 0:
+        if steps.created_time is None:
             ctime = mtime = time.time()
         else:
-            ctime = log[0]["date"]
-            mtime = log[-1]["date"]
+            ctime = steps.created_time
+            mtime = steps.modified_time
 
         for key in list(meta.keys()):
             if key[0] == "_":
@@ -160,17 +492,39 @@ class BSFamily:
 
         return meta
 
-    def get_infos(self, **kw):
-        _all = self.dbs.keys()
-        return sorted(
-            [
-                self.get_info(X)
-                for X in _all
-                if (
-                    (not kw.get("since"))
-                    or float(kw["since"]) < self.get_info(X)["modified_time"]
-                )
-            ],
-            key=lambda x: x["created_time"],
-            reverse=True,
-        )
+    def get_infos(self, since=None, limit=None, cursor=None, order="created"):
+        # Newest first, by `order' (created or modified). With `limit',
+        # returns a page {infos, cursor}; pass `cursor' back for the next.
+        for uid in self.known:
+            if uid not in self.infos and cluster.owns(uid):
+                self.get_info(uid)
+
+        key = "%s_time" % (order)
+        if since:
+            # Range lookup on the modified index
+            start = bisect.bisect_right(self.by_modified, (float(since), chr(0x10FFFF)))
+            candidates = sorted(
+                [(self.infos[uid][key], uid) for _t, uid in self.by_modified[start:]]
+            )
+        elif order == "modified":
+            candidates = self.by_modified
+        else:
+            candidates = self.by_created
+
+        end = len(candidates)
+        if cursor:
+            t, uid = cursor.split(":", 1)
+            end = bisect.bisect_left(candidates, (float(t), uid))
+
+        start = 0
+        if limit is not None:
+            start = max(0, end - int(limit))
+
+        infos = [dict(self.infos[uid]) for _t, uid in reversed(candidates[start:end])]
+        if limit is None:
+            return infos
+
+        next_cursor = None
+        if start > 0:
+            next_cursor = "%r:%s" % candidates[start]
+        return {"infos": infos, "cursor": next_cursor}
@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+
+# Runtime metrics, served as JSON by Metrics().
+#
+# Endpoints record their latency with time_request(req); databases, upload
+# stores and stages register themselves with add_source() and report
+# through their metrics() method when the endpoint is read.
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+import bisect
+import collections
+import json
+import time
+import weakref
+
+# Upper bounds (ms) of the latency histogram buckets; the last is open
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        self.counts[bisect.bisect_left(self.buckets, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q'th observation
+        rank = q * self.count
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return self.buckets[idx] if idx < len(self.buckets) else self.max
+        return None
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count if self.count else None,
+            "max_ms": self.max,
+            "p50_ms": self.quantile(0.5),
+            "p90_ms": self.quantile(0.9),
+            "p99_ms": self.quantile(0.99),
+            "buckets": dict(
+                [
+                    ("le_%s" % (b,), c)
+                    for b, c in zip(list(self.buckets) + ["inf"], self.counts)
+                ]
+            ),
+        }
+
+
+class Meter:
+    # A total, and its rate over the last `window' seconds
+    def __init__(self, window=60):
+        self.window = window
+        self.total = 0
+        self.seconds = collections.deque()  # [[second, amount]]
+
+    def mark(self, amount=1):
+        self.total += amount
+        now = int(time.time())
+        if self.seconds and self.seconds[-1][0] == now:
+            self.seconds[-1][1] += amount
+        else:
+            self.seconds.append([now, amount])
+        self._trim(now)
+
+    def _trim(self, now):
+        while self.seconds and self.seconds[0][0] <= now - self.window:
+            self.seconds.popleft()
+
+    def rate(self):
+        self._trim(int(time.time()))
+        return sum([X[1] for X in self.seconds]) / float(self.window)
+
+
+# Request latency by path
+latencies = collections.defaultdict(Histogram)
+
+
+def time_request(req):
+    start = time.time()
+
+    def done(_result):
+        path = req.path.decode("utf-8", "replace")
+        latencies[path].observe(1000 * (time.time() - start))
+        return _result
+
+    req.notifyFinish().addBoth(done)
+
+
+# Kind -> objects with a metrics() method
+sources = collections.defaultdict(weakref.WeakSet)
+
+
+def add_source(kind, obj):
+    sources[kind].add(obj)
+
+
+def remove_source(kind, obj):
+    sources[kind].discard(obj)
+
+
+class LagProbe:
+    # How late the reactor runs a call scheduled every `interval' seconds
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.lag = Histogram()
+        self.last = None
+        self.loop = LoopingCall(self._tick)
+
+    def start(self):
+        if not self.loop.running:
+            self.last = time.time()
+            self.loop.start(self.interval, now=False)
+
+    def _tick(self):
+        now = time.time()
+        self.lag.observe(max(0.0, 1000 * (now - self.last - self.interval)))
+        self.last = now
+
+
+lag_probe = LagProbe()
+
+
+def snapshot():
+    return {
+        "time": time.time(),
+        "reactor_lag": lag_probe.lag.summary(),
+        "endpoints": dict([(k, v.summary()) for k, v in sorted(latencies.items())]),
+        "sources": dict(
+            [
+                (kind, [X.metrics() for X in list(objs)])
+                for kind, objs in sorted(sources.items())
+            ]
+        ),
+    }
+
+
+class Metrics(Resource):
+    isLeaf = True
+
+    def __init__(self):
+        Resource.__init__(self)
+        reactor.callWhenRunning(lag_probe.start)
+
+    def render_GET(self, req):
+        req.setHeader("Content-Type", "application/json")
+        req.setHeader("Cache-Control", "no-cache")
+        return bytes(json.dumps(snapshot()), "utf-8")
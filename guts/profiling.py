@@ -0,0 +1,217 @@
+from __future__ import absolute_import
+
+# Finding what blocks the reactor.
+#
+# StallDetector: the reactor bumps a heartbeat every `interval'; a watchdog
+# thread notices when it stops for more than `threshold' seconds and
+# captures the reactor thread's stack while it's still stuck.
+#
+# Sampler: a thread that samples the reactor thread's stack every
+# `interval' and counts them, dumped as folded stacks ("a;b;c <count>"
+# lines) for flamegraph.pl, speedscope and the like.
+#
+# Profiling() serves both:
+#   stalls        recent stalls, as JSON
+#   start, stop   sampling
+#   folded        the samples so far, as text
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.web.resource import Resource
+
+from . import metrics
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+
+def _stack(frame):
+    # Outermost first
+    out = []
+    while frame is not None:
+        code = frame.f_code
+        out.append(
+            "%s (%s:%d)"
+            % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+        )
+        frame = frame.f_back
+    out.reverse()
+    return out
+
+
+class StallDetector:
+    def __init__(self, threshold=0.2, interval=0.05, keep=50, report=True):
+        self.threshold = threshold
+        self.interval = interval
+        self.report = report
+
+        self.stalls = collections.deque(maxlen=keep)  # most recent last
+        self.count = 0
+        self.max = 0.0
+
+        self.beat = None
+        self.ident = None  # reactor thread
+        self.running = False
+        self.loop = LoopingCall(self._beat)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.beat = time.time()
+        self.ident = threading.get_ident()
+        self.loop.start(self.interval, now=True)
+        thread = threading.Thread(target=self._watch, name="stall detector")
+        thread.daemon = True
+        thread.start()
+        metrics.add_source("stalls", self)
+
+    def stop(self):
+        self.running = False
+        if self.loop.running:
+            self.loop.stop()
+        metrics.remove_source("stalls", self)
+
+    def _beat(self):
+        self.ident = threading.get_ident()
+        now = time.time()
+        stall = self.stalls[-1] if self.stalls else None
+        if stall is not None and stall["open"]:
+            # Over: the reactor got to us again
+            stall["open"] = False
+            stall["duration"] = now - stall["start"]
+            self.max = max(self.max, stall["duration"])
+        self.beat = now
+
+    def _watch(self):
+        while self.running:
+            time.sleep(self.interval)
+            beat = self.beat
+            late = time.time() - beat - self.interval
+            if late < self.threshold:
+                continue
+            if self.stalls and self.stalls[-1]["start"] == beat:
+                # Already captured this one
+                self.stalls[-1]["duration"] = late + self.interval
+                continue
+
+            frame = sys._current_frames().get(self.ident)
+            stack = traceback.format_stack(frame) if frame is not None else []
+            self.count += 1
+            self.stalls.append(
+                {
+                    "start": beat,
+                    "duration": late + self.interval,
+                    "open": True,
+                    "stack": stack,
+                }
+            )
+            if self.report:
+                sys.stderr.write(
+                    "reactor stalled for %.0fms in:\n%s"
+                    % (1000 * (late + self.interval), "".join(stack))
+                )
+
+    def metrics(self):
+        return {"threshold_s": self.threshold, "stalls": self.count, "max_s": self.max}
+
+
+class Sampler:
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = collections.Counter()  # folded stack -> samples
+        self.lock = threading.Lock()
+        self.running = False
+        self.ident = None
+
+    def start(self, ident=None):
+        # Samples the calling thread (the reactor's, usually) unless told
+        # otherwise
+        if self.running:
+            return
+        self.ident = ident if ident is not None else threading.get_ident()
+        self.running = True
+        thread = threading.Thread(target=self._run, name="sampler")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.ident)
+            if frame is None:
+                continue
+            folded = ";".join(_stack(frame))
+            with self.lock:
+                self.counts[folded] += 1
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+
+    def folded(self):
+        with self.lock:
+            counts = dict(self.counts)
+        return "".join(["%s %d\n" % (k, v) for k, v in sorted(counts.items())])
+
+
+detector = None
+sampler = Sampler()
+
+
+def watch_stalls(threshold=0.2, interval=0.05):
+    # Opt in to stall detection; returns the (process-wide) detector
+    global detector
+    if detector is None:
+        detector = StallDetector(threshold=threshold, interval=interval)
+        reactor.callWhenRunning(detector.start)
+    return detector
+
+
+class _Action(Resource):
+    isLeaf = True
+
+    def __init__(self, fn, content_type="application/json"):
+        self.fn = fn
+        self.content_type = content_type
+        Resource.__init__(self)
+
+    def render_GET(self, req):
+        req.setHeader("Content-Type", self.content_type)
+        req.setHeader("Cache-Control", "no-cache")
+        return self.fn(req)
+
+
+class Profiling(Resource):
+    def __init__(self, threshold=0.2):
+        Resource.__init__(self)
+        self.detector = watch_stalls(threshold=threshold)
+
+        self.putChild(b"stalls", _Action(self.get_stalls))
+        self.putChild(b"start", _Action(self.start))
+        self.putChild(b"stop", _Action(self.stop))
+        self.putChild(b"folded", _Action(self.get_folded, "text/plain"))
+
+    def get_stalls(self, req):
+        return bytes(json.dumps(list(self.detector.stalls)), "utf-8")
+
+    def start(self, req):
+        if b"clear" in req.args:
+            sampler.clear()
+        sampler.start()
+        return bytes(json.dumps({"sampling": True}), "utf-8")
+
+    def stop(self, req):
+        sampler.stop()
+        return bytes(json.dumps({"sampling": False}), "utf-8")
+
+    def get_folded(self, req):
+        return bytes(sampler.folded(), "utf-8")
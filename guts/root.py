@@ -1,8 +1,12 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+import collections
 import glob
+import hashlib
 import os
+import sys
+import time
 import traceback
 
 from watchdog.observers import Observer
@@ -12,34 +16,138 @@ from twisted.web.server import Site
 from twisted.web.static import File
 from twisted.internet import reactor
 
-def _load_module(path, g={}):
-    source = open(path).read()
+from . import cluster
+
+# Compiled code by (path, source hash), so that reverting a file doesn't
+# recompile it
+_code_cache = collections.OrderedDict()
+CODE_CACHE_SIZE = 32
+
+def _compile(path, source, digest):
+    key = (path, digest)
+    if key in _code_cache:
+        _code_cache.move_to_end(key)
+        return _code_cache[key]
     code = compile(source, path, 'exec')
+    _code_cache[key] = code
+    if len(_code_cache) > CODE_CACHE_SIZE:
+        _code_cache.popitem(last=False)
+    return code
+
+def _load_module(path, g={}):
+    source = open(path, 'rb').read()
+    code = _compile(path, source, hashlib.sha1(source).hexdigest())
     exec(code, g)
     return g
 
+class Reloader(object):
+    # Re-executes `path' into `g' when it changes. Watchdog fires several
+    # events per save, from its own thread; they are coalesced into one
+    # reload on the reactor, `debounce' seconds after the last. Saves that
+    # leave the source unchanged are skipped.
+    def __init__(self, path, g, root, debounce=0.1):
+        self.path = path
+        self.g = g
+        self.root = root
+        self.debounce = debounce
+
+        self.digest = None  # of the last source that loaded cleanly
+        self.pending = None  # DelayedCall
+
+    def changed(self):
+        # From the watchdog thread
+        reactor.callFromThread(self._schedule)
+
+    def _schedule(self):
+        if self.pending is not None and self.pending.active():
+            self.pending.reset(self.debounce)
+        else:
+            self.pending = reactor.callLater(self.debounce, self.load)
+
+    def load(self):
+        self.pending = None
+        start = time.time()
+        try:
+            source = open(self.path, 'rb').read()
+        except IOError:
+            traceback.print_exc()
+            return
+        digest = hashlib.sha1(source).hexdigest()
+        if digest == self.digest:
+            return
+
+        self.g['root'] = self.root
+        try:
+            code = _compile(self.path, source, digest)
+            compiled = time.time()
+            exec(code, self.g)
+        except Exception:
+            traceback.print_exc()
+            return
+        self.digest = digest
+
+        done = time.time()
+        print('reloaded %s in %.1fms (compile %.1fms, run %.1fms)' % (
+            self.path, 1000 * (done - start), 1000 * (compiled - start),
+            1000 * (done - compiled)))
+
+def _watch_key(path):
+    # Directories are watched by their realpath, so that's how events name
+    # the files in them
+    path = os.path.abspath(path)
+    return os.path.join(os.path.realpath(os.path.dirname(path)),
+                        os.path.basename(path))
+
 class Ev2CB(FileSystemEventHandler):
-    def __init__(self, pathmap):
-        self.pathmap = pathmap  # {path: cb}
+    # Calls the callbacks for a path when it is created, modified or moved
+    # into place (as editors that save atomically do). Paths are resolved
+    # once, when added, rather than on every event.
+    def __init__(self, pathmap=None):
+        self.index = {}  # resolved path -> [cb]
+        for path, cb in (pathmap or {}).items():
+            self.add(path, cb)
         FileSystemEventHandler.__init__(self)
 
-    def get_cb(self, ev):
-        print('get_cb', ev.src_path, ev)
-        for path in self.pathmap.keys():
-            if os.path.realpath(ev.src_path) == os.path.realpath(path):
-                return self.pathmap[path]
-        return None
+    def add(self, path, cb):
+        self.index.setdefault(_watch_key(path), []).append(cb)
 
-    def on_created(self, ev):
-        cb = self.get_cb(ev)
-        if cb:
+    def _fire(self, path):
+        for cb in self.index.get(path, ()):
             cb()
+
+    def on_created(self, ev):
+        self._fire(ev.src_path)
     def on_deleted(self, ev):
         pass
     def on_modified(self, ev):
-        cb = self.get_cb(ev)
-        if cb:
-            cb()
+        self._fire(ev.src_path)
+    def on_moved(self, ev):
+        self._fire(ev.dest_path)
+
+class Watcher(object):
+    # One observer thread for every watched file in the process
+    def __init__(self):
+        self.obs = Observer()
+        self.handler = Ev2CB()
+        self.dirs = set()
+        self.obs.start()
+
+    def add(self, path, cb):
+        self.handler.add(path, cb)
+        dirpath = os.path.dirname(_watch_key(path))
+        if dirpath not in self.dirs:
+            self.dirs.add(dirpath)
+            self.obs.schedule(self.handler, dirpath)
+
+_watcher = None
+
+def watch(path, cb):
+    # cb() is called from the observer thread whenever `path' changes
+    global _watcher
+    if _watcher is None:
+        _watcher = Watcher()
+    _watcher.add(path, cb)
+    return _watcher.obs
 
 # def print_errors(f):
 #     def g(*a, **kw):
@@ -51,15 +159,17 @@ class Ev2CB(FileSystemEventHandler):
 #    return g
 
 def _monitor_changes(path, cb):
-    obs = Observer()
-    e2cb = Ev2CB({path: cb})
-    obs.schedule(e2cb, os.path.dirname(os.path.abspath(path)))
-    obs.start()
-    return obs
+    return watch(path, cb)
 
 
 class Root(object):
-    def __init__(self, port=8000, interface='0.0.0.0', dirpath='.'):
+    def __init__(self, port=8000, interface='0.0.0.0', dirpath='.', workers=1):
+        if workers > 1 and not cluster.is_worker():
+            # This process only supervises; the workers (re-running this
+            # script) build the resources and serve. See cluster.py.
+            cluster.run_master(port, interface, workers)
+            sys.exit(0)
+
         self._port = port
         self._interface = interface
         self._root = File(dirpath)
@@ -69,28 +179,20 @@ class Root(object):
 
     def run_forever(self):
         site = Site(self._root)
-        reactor.listenTCP(self._port, site, interface=self._interface)
-        print("http://localhost:%d" % (self._port))
+        if cluster.is_worker():
+            cluster.adopt_ports(site)
+        else:
+            reactor.listenTCP(self._port, site, interface=self._interface)
+            print("http://localhost:%d" % (self._port))
         reactor.run()        
 
-def serve(path, g, root=None, **kw):
+def serve(path, g, root=None, debounce=0.1, **kw):
     if root is None:
         root = Root(**kw)
 
-    def load():
-        print('load!')
-        g['root'] = root
-        try:
-            module = _load_module(path, g=g)
-        except Exception:
-            traceback.print_exc()
-            return
-
-        # for k,v in module.items():
-        #     root.cbs[k] = print_errors(v)
-
-    load()
-    obs = _monitor_changes(path, load)
+    reloader = Reloader(path, g, root, debounce=debounce)
+    reloader.load()
+    obs = _monitor_changes(path, reloader.changed)
     try:
         root.run_forever()
     except KeyboardInterrupt:
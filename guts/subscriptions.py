@@ -0,0 +1,175 @@
+# websocket-based live queries over a BSFamily
+#
+# client: {cmd: subscribe, sub: <name>, ids: [<db id>, ...], [type: <type>],
+#          [unless: <field>]}
+# server: {type: subscribed, sub: <name>, results: {<db id>: [docs]}}
+#
+# ...then, as changes are applied to those databases:
+# server: {type: delta, sub: <name>, db: <db id>, op: add|update|remove,
+#          id: <doc id>, [doc: <doc>]}
+#
+# client: {cmd: unsubscribe, sub: <name>}
+#
+# `type' and `unless' filter as they do for _query.json. Unknown db ids are
+# left out of the results; a removed db sends a remove for each of its docs.
+#
+# Under Root(workers=N), databases owned by other workers are left out of
+# `subscribed' too, and their results follow as they arrive:
+# server: {type: results, sub: <name>, db: <db id>, docs: [docs]}
+
+from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
+
+from . import cluster
+
+import json
+
+
+class Subscription:
+    def __init__(self, client, name, ids, type=None, unless=None):
+        self.client = client
+        self.name = name
+        self.ids = ids
+        self.type = type
+        self.unless = unless
+
+        self.matched = {}  # db id -> set of matching doc ids
+        self.watched = set()  # db ids owned by other workers
+
+    def matches(self, doc):
+        if doc is None:
+            return False
+        if self.type is not None and doc.get("type") != self.type:
+            return False
+        if self.unless is not None and doc.get(self.unless):
+            return False
+        return True
+
+
+class SubscribeFactory(WebSocketServerFactory):
+    def __init__(self, family):
+        self.family = family
+        self.by_db = {}  # db id -> set of Subscriptions
+
+        WebSocketServerFactory.__init__(self)
+
+    def subscribe(self, sub):
+        results = {}
+        for uid in sub.ids:
+            if uid not in self.family.known:
+                continue
+            if not cluster.owns(uid):
+                # Ask for its changes before its docs, so none are missed
+                self.family.watch(uid)
+                sub.watched.add(uid)
+                self.family.remote_query(
+                    uid,
+                    sub.type,
+                    sub.unless,
+                    lambda items, uid=uid: self._remote_results(sub, uid, items),
+                )
+                continue
+            items = self.family.query_items(id=uid, type=sub.type, unless=sub.unless)
+            results[uid] = [doc for _id, doc in items]
+            self._track(sub, uid, items)
+        return results
+
+    def _track(self, sub, uid, items):
+        sub.matched[uid] = set([doc_id for doc_id, _doc in items])
+        self.by_db.setdefault(uid, set()).add(sub)
+
+    def _remote_results(self, sub, uid, items):
+        if sub.client.subs.get(sub.name) is not sub or items is None:
+            # Unsubscribed meanwhile, or the db is gone
+            return
+        self._track(sub, uid, items)
+        docs = [doc for _id, doc in items]
+        sub.client.sendMessage(
+            bytes(
+                json.dumps({"type": "results", "sub": sub.name, "db": uid, "docs": docs}),
+                "utf-8",
+            )
+        )
+
+    def unsubscribe(self, sub):
+        for uid in sub.matched:
+            subs = self.by_db.get(uid)
+            if subs is not None:
+                subs.discard(sub)
+                if len(subs) == 0:
+                    del self.by_db[uid]
+        sub.matched = {}
+        for uid in sub.watched:
+            self.family.unwatch(uid)
+        sub.watched = set()
+
+    def ondoc(self, uid, doc_id, doc):
+        # Called once a change to `doc_id' has been applied to db `uid';
+        # `doc' is what's left of it (None if removed)
+        subs = self.by_db.get(uid)
+        if not subs:
+            return
+
+        for sub in list(subs):
+            matched = sub.matched[uid]
+            was = doc_id in matched
+            now = sub.matches(doc)
+            if now:
+                matched.add(doc_id)
+                self.send_delta(sub, uid, "update" if was else "add", doc_id, doc)
+            elif was:
+                matched.discard(doc_id)
+                self.send_delta(sub, uid, "remove", doc_id)
+
+    def onremove(self, uid):
+        for sub in list(self.by_db.pop(uid, ())):
+            for doc_id in sorted(sub.matched.pop(uid, ())):
+                self.send_delta(sub, uid, "remove", doc_id)
+            if uid in sub.watched:
+                sub.watched.discard(uid)
+                self.family.unwatch(uid)
+
+    def send_delta(self, sub, uid, op, doc_id, doc=None):
+        msg = {"type": "delta", "sub": sub.name, "db": uid, "op": op, "id": doc_id}
+        if doc is not None:
+            msg["doc"] = doc
+        sub.client.sendMessage(bytes(json.dumps(msg), "utf-8"))
+
+
+class SubscribeProtocol(WebSocketServerProtocol):
+    def onOpen(self):
+        self.subs = {}  # name -> Subscription
+        WebSocketServerProtocol.onOpen(self)
+
+    def connectionLost(self, reason):
+        for sub in getattr(self, "subs", {}).values():
+            self.factory.unsubscribe(sub)
+        self.subs = {}
+        WebSocketServerProtocol.connectionLost(self, reason)
+
+    def onMessage(self, payload, isBinary):
+        cmd = json.loads(payload)
+
+        if cmd["cmd"] == "subscribe":
+            name = cmd.get("sub")
+            if name in self.subs:
+                self.factory.unsubscribe(self.subs.pop(name))
+            sub = Subscription(
+                self,
+                name,
+                cmd.get("ids", []),
+                type=cmd.get("type"),
+                unless=cmd.get("unless"),
+            )
+            self.subs[name] = sub
+            results = self.factory.subscribe(sub)
+            self.sendMessage(
+                bytes(
+                    json.dumps({"type": "subscribed", "sub": name, "results": results}),
+                    "utf-8",
+                )
+            )
+
+        elif cmd["cmd"] == "unsubscribe":
+            sub = self.subs.pop(cmd.get("sub"), None)
+            if sub is not None:
+                self.factory.unsubscribe(sub)
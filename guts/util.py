@@ -2,21 +2,25 @@ from __future__ import absolute_import
 
 from twisted.web.static import File
 from twisted.web.resource import Resource
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.web.server import NOT_DONE_YET
+from twisted.web import http
 from autobahn.twisted.websocket import WebSocketServerProtocol, WebSocketServerFactory
 from autobahn.twisted.resource import WebSocketResource
 from autobahn.twisted.resource import WebSocketResource
 
-from watchdog.observers import Observer
+import collections
 import hashlib
 import json
 import os
-import time
 
 from . import root
 from . import attachments
 from . import babysteps
+from . import cluster
+from . import metrics
+from . import workers
+from .attachments import AttachmentFile
 
 
 class Get(Resource):
@@ -25,17 +29,80 @@ class Get(Resource):
         Resource.__init__(self)
 
     def render_GET(self, req):
+        metrics.time_request(req)
         return self._fn()
 
 
-class GetArgs(Resource):
-    def __init__(self, fn, fileout=False, runasync=False):
-        self._async = runasync
+def _make_pool(runasync, concurrency, max_queue, timeout, processes):
+    # runasync may be True (a pool of this endpoint's own) or a WorkerPool
+    # shared between endpoints
+    if not runasync:
+        return None
+    if isinstance(runasync, workers.WorkerPool):
+        return runasync
+    return workers.WorkerPool(
+        concurrency=concurrency,
+        max_queue=max_queue,
+        timeout=timeout,
+        processes=processes,
+    )
+
+
+class BadRequest(ValueError):
+    # Raised by an endpoint's function: answers 400 with the message
+    pass
+
+
+def _error_body(req, code, message):
+    req.setResponseCode(code)
+    req.setHeader("Content-Type", "application/json")
+    return bytes(json.dumps({"error": message}), "utf-8")
+
+
+class _AsyncCall:
+    # Runs a request's handler on a worker pool and finishes the request
+    # exactly once, whatever the outcome
+
+    def _run_async(self, req, *args, **kw):
+        try:
+            d = self._pool.submit(self._fn, *args, **kw)
+        except workers.PoolFull:
+            req.setHeader("Retry-After", "1")
+            return _error_body(req, 503, "Server busy")
+
+        gone = []
+        req.notifyFinish().addErrback(lambda _f: gone.append(True))
+
+        def ok(ret):
+            if not gone:
+                self._finish_req(req, ret)
+
+        def fail(f):
+            if gone:
+                return
+            if f.check(BadRequest):
+                body = _error_body(req, 400, str(f.value))
+            elif f.check(defer.TimeoutError):
+                body = _error_body(req, 504, "Timed out")
+            else:
+                print(f.getTraceback())
+                body = _error_body(req, 500, "Unhandled error")
+            req.write(body)
+            req.finish()
+
+        d.addCallbacks(ok, fail)
+        return NOT_DONE_YET
+
+
+class GetArgs(Resource, _AsyncCall):
+    def __init__(self, fn, fileout=False, runasync=False, concurrency=4,
+                 max_queue=64, timeout=None, processes=False):
+        self._pool = _make_pool(runasync, concurrency, max_queue, timeout, processes)
         self._fileout = fileout
         self._fn = fn
         Resource.__init__(self)
 
-    def render_GET(self, req):
+    def _parse_args(self, req):
         args = {}
         for k, v in req.args.items():
             if type(k) == bytes:
@@ -46,24 +113,22 @@ class GetArgs(Resource):
                 args[k] = v
             if type(args[k]) == bytes:
                 args[k] = args[k].decode("utf-8")
+        return args
 
-        if not self._async:
-            ret = self._fn(**args)
+    def render_GET(self, req):
+        metrics.time_request(req)
+        args = self._parse_args(req)
+
+        if self._pool is None:
+            try:
+                ret = self._fn(**args)
+            except BadRequest as err:
+                return _error_body(req, 400, str(err))
             if self._fileout:
                 return File(ret).render_GET(req)
             return bytes(json.dumps(ret), "utf-8")
         else:
-            reactor.callInThread(self._call_fn, args, req)
-            return NOT_DONE_YET
-
-    def _call_fn(self, args, req):
-        try:
-            ret = self._fn(**args)
-        except Exception as e:
-            print(e)
-            reactor.callFromThread(self._finish_req, req, "Unhandled error")
-            raise e
-        reactor.callFromThread(self._finish_req, req, ret)
+            return self._run_async(req, **args)
 
     def _finish_req(self, req, ret):
         if self._fileout:
@@ -72,27 +137,78 @@ class GetArgs(Resource):
         req.finish()
 
 
-class PostJson(Resource):
-    def __init__(self, fn, runasync=False):
+class CachedGetArgs(GetArgs):
+    # A GetArgs whose responses are cached per set of arguments until
+    # version(**args) changes, with ETags so that unchanged responses
+    # can be answered with 304 Not Modified. The cache holds at most
+    # `max_bytes' of response bodies, dropping the least recently used.
+    def __init__(self, fn, version, max_bytes=2**24):
+        self._version = version
+        self.max_bytes = max_bytes
+        self.cache = collections.OrderedDict()  # args -> (version, etag, body)
+        self.cache_bytes = 0
+        GetArgs.__init__(self, fn)
+
+    def render_GET(self, req):
+        metrics.time_request(req)
+        args = self._parse_args(req)
+        key = tuple(sorted((k, json.dumps(v)) for k, v in args.items()))
+        version = self._version(**args)
+
+        entry = self.cache.get(key)
+        if entry is not None and entry[0] == version:
+            self.cache.move_to_end(key)
+        else:
+            try:
+                ret = self._fn(**args)
+            except BadRequest as err:
+                return _error_body(req, 400, str(err))
+            body = bytes(json.dumps(ret), "utf-8")
+            etag = bytes('"%s"' % (hashlib.sha1(body).hexdigest()), "utf-8")
+            entry = (version, etag, body)
+            self._store(key, entry)
+
+        req.setHeader("Cache-Control", "no-cache")
+        if req.setETag(entry[1]) is http.CACHED:
+            return b""
+        return entry[2]
+
+    def _store(self, key, entry):
+        old = self.cache.pop(key, None)
+        if old is not None:
+            self.cache_bytes -= len(old[2])
+        if len(entry[2]) > self.max_bytes:
+            # Too big to keep; served once, computed again next time
+            return
+        self.cache[key] = entry
+        self.cache_bytes += len(entry[2])
+        while self.cache_bytes > self.max_bytes:
+            _key, dropped = self.cache.popitem(last=False)
+            self.cache_bytes -= len(dropped[2])
+
+
+class PostJson(Resource, _AsyncCall):
+    def __init__(self, fn, runasync=False, concurrency=4, max_queue=64,
+                 timeout=None, processes=False):
         self._fn = fn
 
-        self._async = runasync
+        self._pool = _make_pool(runasync, concurrency, max_queue, timeout, processes)
 
         Resource.__init__(self)
 
     def render_POST(self, req):
+        metrics.time_request(req)
         cmd = json.load(req.content)
         # Pass through access to the request
 
-        if not self._async:
-            return bytes(json.dumps(self._fn(cmd)), "utf-8")
+        if self._pool is None:
+            try:
+                ret = self._fn(cmd)
+            except BadRequest as err:
+                return _error_body(req, 400, str(err))
+            return bytes(json.dumps(ret), "utf-8")
         else:
-            reactor.callInThread(self._call_fn, cmd, req)
-            return NOT_DONE_YET
-
-    def _call_fn(self, cmd, req):
-        ret = self._fn(cmd)
-        reactor.callFromThread(self._finish_req, req, ret)
+            return self._run_async(req, cmd)
 
     def _finish_req(self, req, ret):
         req.write(bytes(json.dumps(ret), "utf-8"))
@@ -102,44 +218,110 @@ class PostJson(Resource):
 JsonPost = PostJson
 
 
-def Babysteps(dbpath="db"):
-    factory = babysteps.DBFactory(dbpath=dbpath)
+def Babysteps(dbpath="db", snapshot_every=None, compact=False,
+              durability="buffered", group_ms=10, group_size=100,
+              coalesce=False, Stepper=babysteps.Babysteps, log_format="json",
+              partition=True, checkpoint_every=None, max_checkpoints=64):
+    # Under Root(workers=N) a db is served by the worker owning its path;
+    # partition=False serves it from here regardless (BSFamily partitions
+    # by uid itself)
+    if partition and not cluster.owns(dbpath):
+        relay = cluster.Relay(cluster.owner(dbpath))
+        relay.dbpath = dbpath  # for bschange
+        return relay
+
+    factory = babysteps.DBFactory(
+        dbpath=dbpath,
+        Stepper=Stepper,
+        snapshot_every=snapshot_every,
+        compact=compact,
+        durability=durability,
+        group_ms=group_ms,
+        group_size=group_size,
+        coalesce=coalesce,
+        log_format=log_format,
+        checkpoint_every=checkpoint_every,
+        max_checkpoints=max_checkpoints,
+    )
     factory.protocol = babysteps.DBProtocol
+    if partition:
+        _owned_dbs[dbpath] = factory
     return WebSocketResource(factory)
 
 
 def Attachments(attachdir="local/_attachments"):
+    if not cluster.owns(attachdir):
+        return cluster.Relay(cluster.owner(attachdir))
+
     a_factory = attachments.AttachFactory(attachdir=attachdir)
     a_factory.protocol = attachments.AttachProtocol
     return WebSocketResource(a_factory)
 
 
+def AttachmentQuery(attach_res):
+    # GET endpoint over an Attachments() store's index
+    if hasattr(attach_res, "owner"):
+        # ...which another worker serves
+        return cluster.Proxy(attach_res.owner)
+    return GetArgs(attach_res._factory.index.query)
+
+
 def attach(filepath, attachdir="local/_attachments", copy=False):
-    # XXX: This should be in the attachments.py file probably
-    sha1 = hashlib.sha1()
-    with open(filepath, "rb") as fh:
-        buf = fh.read(2 ** 15)
-        while len(buf) > 0:
-            sha1.update(buf)
-            buf = fh.read(2 ** 15)
-
-    return attachments.move_to_database(
-        filepath, sha1.hexdigest(), attachdir, copy=copy
+    return attachments.attach(filepath, attachdir=attachdir, copy=copy)
+
+
+def attach_tree(dirpath, attachdir="local/_attachments", copy=True, workers=4,
+                progress=None):
+    return attachments.attach_tree(
+        dirpath, attachdir=attachdir, copy=copy, workers=workers, progress=progress
     )
 
 
 class BSPeer:
     def __init__(self, name):
         self.peername = name
+        self.peer = name  # what DBFactory.onchange records
+
+
+_owned_dbs = {}  # dbpath -> DBFactory, for bschanges from other workers
+
+
+def _remote_bschange(msg, sender):
+    factory = _owned_dbs.get(msg["dbpath"])
+    if factory is None:
+        print("bschange for unknown db", msg["dbpath"])
+        return
+    peer = BSPeer(msg["peername"]) if msg["peername"] is not None else None
+    factory.onchange(peer, msg["change"])
+
+
+cluster.channel.subscribe("bschange", _remote_bschange)
 
 
 def bschange(bs, change, sync=False, peername=None):
+    if hasattr(bs, "owner"):
+        # Another worker serves this db (see Babysteps): the change is
+        # applied there, some time after we return, even with `sync'
+        msg = {"dbpath": bs.dbpath, "change": change, "peername": peername}
+        if sync:
+            cluster.channel.publish("bschange", msg, to=bs.owner)
+        else:
+            reactor.callFromThread(
+                cluster.channel.publish, "bschange", msg, to=bs.owner
+            )
+        return
+
     peer = None
     if peername is not None:
         peer = BSPeer(peername)
 
     def do_change(changedoc):
-        bs._factory.onchange(peer, changedoc)
+        db = bs
+        if getattr(bs, "reopen", None) is not None:
+            # A BSFamily db, which may have been closed since: use whatever
+            # is open for its uid now
+            db = bs.reopen()
+        db._factory.onchange(peer, changedoc)
 
     if sync:
         do_change(change)
@@ -148,67 +330,76 @@ def bschange(bs, change, sync=False, peername=None):
 
 
 class StageFactory(WebSocketServerFactory):
-    def __init__(self, scriptpath="stage.js", csspath="stage.css", wwwdir="."):
-
+    # Pushes assets to clients as they change. Each is sent as
+    # {path: <path>?h=<content hash>, type: script|style}, so URLs (and
+    # caches) only change with the content, and touching a file without
+    # changing it pushes nothing.
+    def __init__(self, scriptpath="stage.js", csspath="stage.css", wwwdir=".",
+                 assets=None):
         self.wwwdir = wwwdir
 
         self.scriptpath = scriptpath
         self.csspath = csspath
 
-        # Set up monitors
-        self.obs = Observer()
-        e2cb = root.Ev2CB(
-            {
-                os.path.join(self.wwwdir, self.scriptpath): self._onscriptchange,
-                os.path.join(self.wwwdir, self.csspath): self._oncsschange,
-            }
-        )
-
-        # XXX: stage and css must be in same directory!
-        self.obs.schedule(e2cb, os.path.realpath(wwwdir))
-        self.obs.start()
+        # Paths relative to wwwdir, in load order
+        if assets is None:
+            assets = [scriptpath, csspath]
+        self.assets = list(assets)
+        self.hashes = {}  # path -> content hash
+
+        for path in self.assets:
+            self.hashes[path] = self._hash(path)
+            root.watch(
+                os.path.join(self.wwwdir, path),
+                lambda path=path: self._onchange(path),
+            )
 
         self.clients = {}
+        metrics.add_source("stage", self)
 
         WebSocketServerFactory.__init__(self)
 
-    def _onscriptchange(self):
-        path = self.scriptpath + "?t=%f" % time.time()
-        reactor.callFromThread(
-            self.push_all, bytes(json.dumps({"path": path, "type": "script"}), "utf-8")
-        )
+    def metrics(self):
+        return {"assets": len(self.assets), "clients": len(self.clients)}
 
-    def _oncsschange(self):
-        path = self.csspath + "?t=%f" % time.time()
-        reactor.callFromThread(
-            self.push_all, bytes(json.dumps({"path": path, "type": "style"}), "utf-8")
+    def _hash(self, path):
+        try:
+            with open(os.path.join(self.wwwdir, path), "rb") as fh:
+                return hashlib.sha1(fh.read()).hexdigest()[:12]
+        except IOError:
+            return None
+
+    def _onchange(self, path):
+        # From the observer thread, which can afford to read the file
+        reactor.callFromThread(self._changed, path, self._hash(path))
+
+    def _changed(self, path, digest):
+        if digest is None or digest == self.hashes.get(path):
+            return
+        self.hashes[path] = digest
+        self.push_all(self._message(path))
+
+    def _message(self, path):
+        kind = "style" if path.endswith(".css") else "script"
+        return bytes(
+            json.dumps(
+                {"path": "%s?h=%s" % (path, self.hashes[path]), "type": kind}
+            ),
+            "utf-8",
         )
 
     def push_all(self, msg):
-        print("pushing!", msg)
+        prepared = self.prepareMessage(msg)
         for client in self.clients.values():
-            client.sendMessage(msg)
+            client.sendPreparedMessage(prepared)
 
     def register(self, client):
         self.clients[client.peer] = client
 
-        # initialize w/a hit to both paths
-        client.sendMessage(
-            bytes(
-                json.dumps(
-                    {"path": self.scriptpath + "?t=%f" % time.time(), "type": "script"}
-                ),
-                "utf-8",
-            )
-        )
-        client.sendMessage(
-            bytes(
-                json.dumps(
-                    {"path": self.csspath + "?t=%f" % time.time(), "type": "style"}
-                ),
-                "utf-8",
-            )
-        )
+        # initialize w/a hit to every asset
+        for path in self.assets:
+            if self.hashes.get(path) is not None:
+                client.sendMessage(self._message(path))
 
     def unregister(self, client):
         if client.peer in self.clients:
@@ -229,7 +420,9 @@ class StageProtocol(WebSocketServerProtocol):
         pass
 
 
-def Codestage(scriptpath="stage.js", csspath="stage.css", wwwdir="."):
-    factory = StageFactory(scriptpath=scriptpath, csspath=csspath, wwwdir=wwwdir)
+def Codestage(scriptpath="stage.js", csspath="stage.css", wwwdir=".", assets=None):
+    factory = StageFactory(
+        scriptpath=scriptpath, csspath=csspath, wwwdir=wwwdir, assets=assets
+    )
     factory.protocol = StageProtocol
     return WebSocketResource(factory)
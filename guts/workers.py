@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+
+# Bounded worker pools for runasync endpoints.
+#
+# Each pool runs at most `concurrency' calls at once and queues at most
+# `max_queue' more; beyond that submit() raises PoolFull so the caller
+# can shed load instead of piling work onto a shared thread pool. With
+# processes=True the calls run in worker processes (fn and its arguments
+# must then be picklable, i.e. module-level functions).
+#
+# All bookkeeping happens on the reactor thread. Pools aren't kept alive by
+# anything but their users: endpoints rebuilt on a hot reload let their old
+# pools (and threads) go.
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from twisted.internet import defer, reactor
+
+import weakref
+
+
+class PoolFull(Exception):
+    pass
+
+
+# Open pools, closed at shutdown by a single trigger
+_pools = weakref.WeakSet()
+
+
+def _close_all():
+    for pool in list(_pools):
+        pool.close()
+
+
+reactor.addSystemEventTrigger("before", "shutdown", _close_all)
+
+
+class WorkerPool:
+    def __init__(self, concurrency=4, max_queue=64, timeout=None, processes=False):
+        self.concurrency = concurrency
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.processes = processes
+
+        self.pending = 0  # running + queued
+        self._executor = None
+        self._finalizer = None
+
+        _pools.add(self)
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.processes:
+                self._executor = ProcessPoolExecutor(max_workers=self.concurrency)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+            # Shut it down if we're dropped without being closed
+            self._finalizer = weakref.finalize(
+                self, self._executor.shutdown, wait=False, cancel_futures=True
+            )
+        return self._executor
+
+    def submit(self, fn, *args, **kw):
+        # Returns a Deferred firing with fn's result (or failure). A timeout
+        # fails the Deferred with defer.TimeoutError; the call itself can't
+        # be interrupted once running, so its slot stays taken until it
+        # returns.
+        if self.pending >= self.concurrency + self.max_queue:
+            raise PoolFull()
+
+        future = self._get_executor().submit(fn, *args, **kw)
+        self.pending += 1
+
+        # Cancelling drops the call if it's still queued
+        d = defer.Deferred(lambda _d: future.cancel())
+        future.add_done_callback(
+            lambda f: reactor.callFromThread(self._done, f, d)
+        )
+        if self.timeout is not None:
+            d.addTimeout(self.timeout, reactor)
+        return d
+
+    def _done(self, future, d):
+        self.pending -= 1
+        if d.called:
+            # Timed out or cancelled already
+            return
+        if future.cancelled():
+            d.errback(defer.CancelledError())
+            return
+        exc = future.exception()
+        if exc is not None:
+            d.errback(exc)
+        else:
+            d.callback(future.result())
+
+    def close(self):
+        if self._executor is not None:
+            self._finalizer()
+            self._executor = None
@@ -14,7 +14,8 @@ var A = A || {};
         return window.location.host + '/' +  pname;
     }
 
-    $.Attachments = function(dbpath) {
+    // `uploader' (optional) names us in the server's attachment index
+    $.Attachments = function(dbpath, uploader) {
         // Connect
         var proto = window.location.protocol;
         var wsproto = 'ws://';
@@ -22,19 +23,26 @@ var A = A || {};
             wsproto = 'wss://';
         }
 
-        var wsurl = wsproto + (dbpath ? window.location.host + dbpath : basepath() + "_attach");        
-        var proto = window.location.protocol;
+        this.uploader = uploader;
+        this._wsurl = wsproto + (dbpath ? window.location.host + dbpath : basepath() + "_attach");
 
-        this.upload_queue = [];   // [{file: File, success_cb:, progress_cb: }]
+        this.upload_queue = [];   // [{file: File, success_cb:, progress_cb:, sha1: }]
         this.cur_uploading= null; // {} | null
 
-        this.socket = new WebSocket(wsurl);
+        this._connect();
+    }
+
+    $.Attachments.prototype._connect = function() {
+        this.socket = new WebSocket(this._wsurl);
         this.socket.onmessage = this._onmessage.bind(this)
-        this.socket.onclose = this._onclose.bind(this)        
+        this.socket.onclose = this._onclose.bind(this)
+        this.socket.onopen = this._onopen.bind(this)
     }
 
-    $.Attachments.prototype.put_file = function(file, success_cb, progress_cb) {
-        this.upload_queue.push({file: file, success_cb: success_cb, progress_cb: progress_cb})
+    // If the file's `sha1' (hex) is known, the server can skip the upload
+    // when it already has the content.
+    $.Attachments.prototype.put_file = function(file, success_cb, progress_cb, sha1) {
+        this.upload_queue.push({file: file, success_cb: success_cb, progress_cb: progress_cb, sha1: sha1})
 
         if(!this.cur_uploading) {
             this.start_next_upload();
@@ -50,34 +58,67 @@ var A = A || {};
         var f = this.cur_uploading.file;
 
         // Send metadata to server
-        var meta = {type: "start-upload", filename: f.name, size: f.size}
+        var meta = {type: "start-upload", filename: f.name, size: f.size, windowed: true}
+        if(this.cur_uploading.sha1) {
+            meta.sha1 = this.cur_uploading.sha1;
+        }
+        if(this.uploader) {
+            meta.uploader = this.uploader;
+        }
         this.socket.send(JSON.stringify(meta));
 
         this.cur_idx = 0;
+        this.cur_acked = 0;
+        this.cur_window = 0;
         this.cur_size = meta.size;
-
-        this.send_next_chunk();
+        this.cur_token = null;
+        // ...and wait for upload-started (with our window) to send data
     }
     $.Attachments.prototype.send_next_chunk = function() {
-        // ~128kb
+        // ~256kb
         var chunk_len = Math.min(Math.pow(2, 18), this.cur_size - this.cur_idx);
         var chunk = this.cur_uploading.file.slice(this.cur_idx, this.cur_idx+chunk_len);
         this.socket.send(chunk);
         this.cur_idx += chunk_len;
     }
+    $.Attachments.prototype.pump = function() {
+        // Keep up to a window's worth of unacknowledged data in flight
+        do {
+            this.send_next_chunk();
+        } while(this.cur_idx < this.cur_size &&
+                this.cur_idx - this.cur_acked < this.cur_window);
+    }
 
     $.Attachments.prototype._onmessage = function(e) {
         var res = JSON.parse(e.data);
         if(res.type == 'upload-started') {
             console.log('got id', res.id);
             this.cur_id = res.id;
+            this.cur_token = res.token;
+            this.cur_window = res.window || 0;
+            this.pump();
+        }
+        else if(res.type == 'upload-resumed') {
+            this.cur_idx = this.cur_acked = res.size;
+            if(this.cur_idx < this.cur_size) {
+                this.pump();
+            }
+        }
+        else if(res.type == 'resume-failed') {
+            // Start this one over
+            this.upload_queue.splice(0, 0, this.cur_uploading);
+            this.cur_uploading = null;
+            this.start_next_upload();
         }
         else if(res.type == "got-chunk") {
+            this.cur_acked = res.size;
             this.cur_uploading.progress = res.size;
             if(this.cur_uploading.progress_cb) {
                 this.cur_uploading.progress_cb(res.size, this.cur_uploading);
             }
-            this.send_next_chunk();
+            if(this.cur_idx < this.cur_size) {
+                this.pump();
+            }
         }
         else if(res.type == "upload-finished") {
             console.log('finished! starting next upload')
@@ -100,10 +141,24 @@ var A = A || {};
     $.Attachments.prototype.onunknown = function(cmd) {
         console.log("Unknown command", cmd);
     }
+    $.Attachments.prototype._onopen = function() {
+        if(!this.cur_uploading) {
+            return;
+        }
+        if(this.cur_token) {
+            // Pick up where the server left off
+            this.socket.send(JSON.stringify({
+                type: "resume-upload", token: this.cur_token, windowed: true,
+                offset: this.cur_uploading.progress || 0}));
+        }
+        else {
+            this.upload_queue.splice(0, 0, this.cur_uploading);
+            this.cur_uploading = null;
+            this.start_next_upload();
+        }
+    }
     $.Attachments.prototype._onclose = function() {
-        alert("connection to database closed. will reload");
-        window.setTimeout(function() {
-            window.location.reload();
-        }, 2000);
+        console.log("lost connection to attachments - reconnecting in 2secs");
+        window.setTimeout(this._connect.bind(this), 2000);
     }
 })(A);
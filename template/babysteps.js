@@ -19,6 +19,12 @@ var BS = BS || {};
 
         this._log = log || [];
         this._docs = {};
+        // Number of server changes we hold (the log may start from a snapshot)
+        this._seq = this._log.length;
+        // Local changes go out (and count towards _seq) only once we're
+        // connected and caught up; until then they wait here
+        this._pending = [];  // [{msg:, n: number of changes}]
+        this._synced = false;
 
         if(log === undefined) {
             // Connect
@@ -28,10 +34,8 @@ var BS = BS || {};
                 wsproto = 'wss://';
             }
 
-            var wsurl = wsproto + (dbpath ? window.location.host + dbpath : basepath() + "_db");
-            this.socket = new WebSocket(wsurl);
-            this.socket.onmessage = this._onmessage.bind(this)
-            this.socket.onclose = this._onclose.bind(this)
+            this._wsurl = wsproto + (dbpath ? window.location.host + dbpath : basepath() + "_db");
+            this._connect();
         }
         else {
             // If log provided, don't connect to a socket
@@ -49,21 +53,73 @@ var BS = BS || {};
         }
     }
 
+    $.DB.prototype._connect = function() {
+        // Ask the server only for the changes we don't have yet
+        this._synced = false;
+        this.socket = new WebSocket(this._wsurl + '?seq=' + this._seq);
+        this.socket.onmessage = this._onmessage.bind(this)
+        this.socket.onclose = this._onclose.bind(this)
+    }
+
     $.DB.prototype._onmessage = function(e) {
         var res = JSON.parse(e.data);
         if(res.type == 'history') {
-            this._log = res.history;
+            if(res.reset) {
+                // Server couldn't resume from our position; start over
+                this._log = [];
+                this._docs = {};
+                this._seq = 0;
+                this._reset = true;
+            }
 
-            this._log.forEach(function(c) {
+            res.history.forEach(function(c) {
+                this._log.push(c);
                 this._process_change(c);
             }, this);
+            // A snapshot's `seq' is already the position after applying it
+            this._seq = res.snapshot ? res.seq : this._seq + res.history.length;
 
-            this.loaded = true;
-            this.onload();
+            if(res.done !== false) {
+                if(this._reset) {
+                    // Put back what we have yet to send
+                    this._reset = false;
+                    this._pending.forEach(function(p) {
+                        (p.msg.type == 'batch' ? p.msg.changes : [p.msg]).forEach(function(c) {
+                            this._log.push(c);
+                            this._process_change(c);
+                        }, this);
+                    }, this);
+                }
+                this._synced = true;
+                this._flush();
+
+                if(!this.loaded) {
+                    this.loaded = true;
+                    this.onload();
+                }
+            }
+        }
+        else if(res.type == 'changes') {
+            // Several changes coalesced into one message
+            res.changes.forEach(function(c) {
+                this._log.push(c);
+                this._seq += 1;
+                this._process_change(c);
+            }, this);
+        }
+        else if(res.type == 'seq-confirm') {
+            // Answers to changes sent with a seq_idx
+        }
+        else if(res.type == 'batch-failed') {
+            // The server applied none of it, but we already did: resync
+            // from scratch (an impossible seq makes the server reset us)
+            console.log('batch failed', res.error);
+            this._seq = -1;
+            this.socket.close();
         }
         else {
-            // XXX: should be a list of changes
             this._log.push(res);
+            this._seq += 1;
             this._process_change(res);
         }
     }
@@ -113,9 +169,7 @@ var BS = BS || {};
         this._set(id, key, val);
         var logentry = {type: 'set', id: id, key: key, val: val, date: new Date().getTime()/1000};
         this._log.push(logentry);
-        if(this.socket) {
-            this.socket.send(JSON.stringify(logentry));
-        }
+        this._send(logentry, 1);
 
         return this.get(id);
     }
@@ -123,21 +177,37 @@ var BS = BS || {};
         this._remove(id, key);
         var logentry = {type: 'remove', id: id, key: key, date: new Date().getTime()/1000};
         this._log.push(logentry);
-        if(this.socket) {
-            this.socket.send(JSON.stringify(logentry));
-        }
+        this._send(logentry, 1);
     }
     $.DB.prototype.batch = function(changes) {
         // TODO: this should presumably be pseudo-atomic wrt mutable state & events
         changes.forEach(function(c) {
             this._log.push(c);
             this._process_change(c);
-            // TODO: should send to socket all at once
-            if(this.socket) {
-                this.socket.send(JSON.stringify(c));
-            }
         }, this);
-        //this.socket.send(JSON.stringify(changes));
+        // The server applies, logs and broadcasts the lot as one unit
+        this._send({type: 'batch', changes: changes}, changes.length);
+    }
+
+    $.DB.prototype._send = function(msg, n) {
+        if(!this._wsurl) {
+            // Not connected to anything
+            return;
+        }
+        this._pending.push({msg: msg, n: n});
+        this._flush();
+    }
+    $.DB.prototype._flush = function() {
+        // Sent changes are in the server's log, so they count towards our
+        // position; the server never sends them back to us
+        if(!this._synced || !this.socket || this.socket.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        this._pending.forEach(function(p) {
+            this.socket.send(JSON.stringify(p.msg));
+            this._seq += p.n;
+        }, this);
+        this._pending = [];
     }
     
 
@@ -186,10 +256,8 @@ var BS = BS || {};
     // Events
     // -- 
     $.DB.prototype._onclose = function(e) {
-        console.log("lost connection to db - reloading in 2secs");
-        window.setTimeout(function() {
-            window.location.reload();
-        }, 2000);
+        console.log("lost connection to db - reconnecting in 2secs");
+        window.setTimeout(this._connect.bind(this), 2000);
     }
 
     $.DB.prototype.onload = function() {